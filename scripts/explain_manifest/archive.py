@@ -0,0 +1,450 @@
+import io
+import os
+import bz2
+import json
+import gzip
+import lzma
+import stat
+import struct
+import tarfile
+
+RPM_LEAD_MAGIC = b"\xed\xab\xee\xdb"
+RPM_HEADER_MAGIC = b"\x8e\xad\xe8\x01"
+RPMTAG_PAYLOADFORMAT = 1124
+RPMTAG_PAYLOADCOMPRESSOR = 1125
+RPM_STRING_TYPE = 6
+
+CPIO_TRAILER = "TRAILER!!!"
+
+WHITEOUT_PREFIX = ".wh."
+WHITEOUT_OPAQUE = ".wh..wh..opq"
+
+# GOARCH of the machine, preferred when the image has multiple platforms
+OCI_ARCHS = {"x86_64": "amd64", "aarch64": "arm64"}
+
+# platform read from multi-platform images, "os/arch[/variant]" like
+# docker's --platform, see set_image_platform; the machine's if not set
+image_platform = None
+
+
+def set_image_platform(platform: str):
+    global image_platform
+    image_platform = platform
+
+
+class ArchiveEntry():
+    __slots__ = ("name", "mode", "uid", "gid", "size", "link", "content", "source")
+
+    on_disk = False
+
+    def __init__(self, name, mode, uid=0, gid=0, size=0, link=None, content=None):
+        self.name = name
+        self.mode = mode
+        self.uid = uid
+        self.gid = gid
+        self.size = size
+        self.link = link
+        # only set for the entries the caller asked to materialize
+        self.content = content
+        # ArchiveContent to read the content from when it's not materialized
+        self.source = None
+
+    def is_dir(self):
+        return stat.S_ISDIR(self.mode)
+
+    def is_symlink(self):
+        return stat.S_ISLNK(self.mode)
+
+    def is_file(self):
+        return stat.S_ISREG(self.mode)
+
+
+def is_archive(path: str):
+    return path.endswith((".deb", ".rpm", ".apk.tar.gz"))
+
+
+def iter_archive(path: str, want_content=lambda name: False):
+    # yields ArchiveEntry of the package payload in archive order, the content
+    # of regular files is only read into memory if want_content(name) is true
+    f = open(path, "rb")
+    try:
+        if path.endswith(".deb"):
+            yield from _iter_deb(f, want_content)
+        elif path.endswith(".rpm"):
+            yield from _iter_rpm(f, want_content)
+        elif path.endswith(".apk.tar.gz"):
+            yield from _iter_tar(f, "gz", want_content)
+        else:
+            raise Exception("Don't know how to process \"%s\"" % path)
+    finally:
+        f.close()
+
+
+def _normalize(name: str):
+    name = name.lstrip("/")
+    while name.startswith("./"):
+        name = name[2:]
+    name = name.rstrip("/")
+    return "" if name == "." else name
+
+
+def _read_exact(f, size: int):
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = f.read(size - len(buf))
+        if not chunk:
+            raise EOFError("unexpected end of archive")
+        buf += chunk
+    return bytes(buf)
+
+
+def _skip(f, size: int):
+    while size > 0:
+        chunk = f.read(min(size, 1024 * 1024))
+        if not chunk:
+            raise EOFError("unexpected end of archive")
+        size -= len(chunk)
+
+
+class _LimitedReader(io.RawIOBase):
+    # exposes the next `size` bytes of f as a stream on its own, so the
+    # decompressors won't read into the following archive member
+    def __init__(self, f, size: int):
+        self._f = f
+        self._remaining = size
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = min(len(b), self._remaining)
+        if n == 0:
+            return 0
+        data = self._f.read(n)
+        b[:len(data)] = data
+        self._remaining -= len(data)
+        return len(data)
+
+
+def _decompress(f, compressor: str):
+    if compressor in ("gz", "gzip"):
+        return gzip.GzipFile(fileobj=f, mode="rb")
+    elif compressor in ("xz", "lzma"):
+        return lzma.LZMAFile(f, mode="rb")
+    elif compressor in ("bz2", "bzip2"):
+        return bz2.BZ2File(f, mode="rb")
+    elif compressor in ("zst", "zstd"):
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception(
+                "zstandard is required to read zstd compressed payloads")
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(f))
+    elif compressor in ("", "tar", "none"):
+        return f
+
+    raise Exception("Unsupported compression \"%s\"" % compressor)
+
+
+def _iter_tar(f, compressor: str, want_content):
+    tf = tarfile.open(fileobj=_decompress(f, compressor), mode="r|")
+    regular_files = {}
+    for member in tf:
+        name = _normalize(member.name)
+        if not name:
+            continue
+
+        entry = ArchiveEntry(name, member.mode, member.uid, member.gid)
+        if member.isdir():
+            entry.mode |= stat.S_IFDIR
+        elif member.issym():
+            # symlink permissions are not meaningful on Linux
+            entry.mode = stat.S_IFLNK | 0o777
+            entry.link = member.linkname
+        elif member.islnk():
+            # hard links are extracted as regular files sharing the content
+            target = regular_files.get(_normalize(member.linkname))
+            entry.mode |= stat.S_IFREG
+            if target:
+                entry.size = target.size
+                entry.content = target.content
+        elif member.isreg():
+            entry.mode |= stat.S_IFREG
+            entry.size = member.size
+            if want_content(name):
+                entry.content = tf.extractfile(member).read()
+            regular_files[name] = entry
+        elif member.ischr():
+            entry.mode |= stat.S_IFCHR
+        elif member.isblk():
+            entry.mode |= stat.S_IFBLK
+        elif member.isfifo():
+            entry.mode |= stat.S_IFIFO
+
+        yield entry
+
+
+def _iter_deb(f, want_content):
+    if f.read(8) != b"!<arch>\n":
+        raise Exception("Not a debian package")
+
+    while True:
+        header = f.read(60)
+        if len(header) < 60:
+            break
+        name = header[:16].decode("ascii").strip().rstrip("/")
+        size = int(header[48:58].decode("ascii").strip())
+
+        if name.startswith("data.tar"):
+            compressor = name[len("data.tar"):].lstrip(".")
+            yield from _iter_tar(_LimitedReader(f, size), compressor, want_content)
+            return
+
+        # ar members are aligned to 2 bytes
+        f.seek(size + size % 2, os.SEEK_CUR)
+
+    raise Exception("No data.tar found in debian package")
+
+
+def _read_rpm_header(f, align: bool = False):
+    magic = _read_exact(f, 16)
+    if magic[:4] != RPM_HEADER_MAGIC:
+        raise Exception("Bad rpm header magic")
+    nindex, hsize = struct.unpack(">II", magic[8:])
+
+    index = _read_exact(f, nindex * 16)
+    store = _read_exact(f, hsize)
+    # the signature header is padded to 8 bytes
+    if align and (16 + nindex * 16 + hsize) % 8:
+        _skip(f, 8 - (16 + nindex * 16 + hsize) % 8)
+
+    strings = {}
+    for i in range(nindex):
+        tag, typ, offset, _ = struct.unpack(">IIII", index[i*16:i*16+16])
+        if typ == RPM_STRING_TYPE:
+            end = store.index(b"\0", offset)
+            strings[tag] = store[offset:end].decode("utf-8")
+    return strings
+
+
+def _iter_rpm(f, want_content):
+    lead = _read_exact(f, 96)
+    if lead[:4] != RPM_LEAD_MAGIC:
+        raise Exception("Not a rpm package")
+
+    _read_rpm_header(f, align=True)  # signature
+    header = _read_rpm_header(f)
+
+    payload_format = header.get(RPMTAG_PAYLOADFORMAT, "cpio")
+    if payload_format != "cpio":
+        raise Exception("Unsupported rpm payload format \"%s\"" % payload_format)
+
+    yield from _iter_cpio(
+        _decompress(f, header.get(RPMTAG_PAYLOADCOMPRESSOR, "gzip")), want_content)
+
+
+def _pad4(n: int):
+    return (4 - n % 4) % 4
+
+
+def _iter_cpio(f, want_content):
+    # hard linked files in newc archives only carry the content with the last
+    # link, hold the others until it shows up
+    pending = {}
+    while True:
+        header = _read_exact(f, 110)
+        if header[:6] not in (b"070701", b"070702"):
+            raise Exception("Unsupported cpio format %s" % header[:6])
+        (ino, mode, uid, gid, nlink, _, filesize, devmajor, devminor,
+         _, _, namesize, _) = [int(header[6+i*8:14+i*8], 16) for i in range(13)]
+
+        name = _read_exact(f, namesize)[:-1].decode("utf-8")
+        _skip(f, _pad4(110 + namesize))
+        if name == CPIO_TRAILER:
+            break
+
+        name = _normalize(name)
+        entry = ArchiveEntry(name, mode, uid, gid, size=filesize)
+
+        links = []
+        if stat.S_ISREG(mode) and nlink > 1:
+            key = (devmajor, devminor, ino)
+            if filesize == 0:
+                pending.setdefault(key, []).append(entry)
+                continue
+            links = pending.pop(key, [])
+
+        if stat.S_ISLNK(mode):
+            entry.link = _read_exact(f, filesize).decode("utf-8")
+            entry.size = 0
+        elif stat.S_ISREG(mode) and any(want_content(e.name) for e in [entry] + links):
+            entry.content = _read_exact(f, filesize)
+        else:
+            _skip(f, filesize)
+        _skip(f, _pad4(filesize))
+
+        for link in links:
+            link.size = entry.size
+            link.content = entry.content
+            yield link
+
+        if name:
+            yield entry
+
+    for links in pending.values():
+        yield from links
+
+
+def _sniff_compression(f):
+    magic = f.peek(6)[:6]
+    if magic[:2] == b"\x1f\x8b":
+        return "gz"
+    elif magic[:4] == b"\x28\xb5\x2f\xfd":
+        return "zst"
+    elif magic == b"\xfd7zXZ\x00":
+        return "xz"
+    return ""
+
+
+def _pick_manifest(manifests):
+    # skip attestations and the like, they don't have a real platform
+    manifests = [m for m in manifests
+                 if m.get("platform", {}).get("os", "linux") != "unknown"]
+    if image_platform:
+        wanted = image_platform.split("/")
+        for m in manifests:
+            if "platform" not in m:
+                return m  # single platform image
+            p = m["platform"]
+            have = (p.get("os"), p.get("architecture"), p.get("variant"))
+            # the variant is optional on both sides (e.g. linux/arm64)
+            if all(w == h or (i == 2 and h is None) for i, (w, h) in enumerate(zip(wanted, have))):
+                return m
+        raise Exception("No manifest for platform \"%s\" in image" % image_platform)
+
+    arch = OCI_ARCHS.get(os.uname().machine, os.uname().machine)
+    for m in manifests:
+        if m.get("platform", {}).get("architecture") == arch:
+            return m
+    return manifests[0]
+
+
+def _image_layers(path: str):
+    # yields the layer streams of a `docker save` tarball or an OCI image
+    # layout (directory or tarball), from the bottom up
+    if os.path.isdir(path):
+        tf = None
+        def open_file(name): return open(os.path.join(path, name), "rb")
+    else:
+        tf = tarfile.open(path)
+        members = {_normalize(m.name): m for m in tf.getmembers()}
+        def open_file(name): return tf.extractfile(members[name])
+
+    def open_blob(digest): return open_file("blobs/" + digest.replace(":", "/", 1))
+
+    try:
+        try:
+            with open_file("manifest.json") as f:
+                layers = [(open_file, name) for name in json.load(f)[0]["Layers"]]
+        except (KeyError, FileNotFoundError):
+            with open_file("index.json") as f:
+                descriptor = _pick_manifest(json.load(f)["manifests"])
+            while True:
+                with open_blob(descriptor["digest"]) as f:
+                    doc = json.load(f)
+                if "manifests" not in doc:
+                    break
+                descriptor = _pick_manifest(doc["manifests"])  # nested index
+            layers = [(open_blob, layer["digest"]) for layer in doc["layers"]]
+
+        for opener, name in layers:
+            with opener(name) as f:
+                yield f
+    finally:
+        if tf:
+            tf.close()
+
+
+# the entries of the merged layers of an image, with the names under each
+# directory so that a whiteout removes a subtree without going through all
+# the entries; directories are indexed even without an entry (not kept)
+class _MergedLayers():
+    def __init__(self):
+        self.entries = {}
+        # directory -> names of its direct children
+        self._children = {}
+
+    def add(self, entry: ArchiveEntry):
+        lower = self.entries.get(entry.name)
+        if lower and lower.is_dir() and not entry.is_dir():
+            self.remove_tree(entry.name)
+        self.entries[entry.name] = entry
+
+        name = entry.name
+        while name:
+            parent = os.path.dirname(name)
+            children = self._children.setdefault(parent, set())
+            if name in children:
+                break  # and so are its parents
+            children.add(name)
+            name = parent
+
+    def remove_tree(self, name: str, keep_self: bool = False):
+        stack = list(self._children.pop(name, ()))
+        while stack:
+            n = stack.pop()
+            self.entries.pop(n, None)
+            stack.extend(self._children.pop(n, ()))
+        if not keep_self:
+            self.entries.pop(name, None)
+            if name:
+                self._children.get(os.path.dirname(name), set()).discard(name)
+
+
+def read_image(path: str, keep=lambda name: True, want_content=lambda name: False,
+               on_entry=None):
+    # merges the image layers in memory and applies the whiteouts, returns
+    # the entries of the resulting filesystem whose names pass keep(name);
+    # on_entry(entry) is called as soon as each of them is read, it may still
+    # be replaced or removed by an upper layer
+    merged = _MergedLayers()
+    for layer in _image_layers(path):
+        layer_entries = []
+        for entry in _iter_tar(layer, _sniff_compression(layer), want_content):
+            parent, base = os.path.split(entry.name)
+            # whiteouts only hide entries from the lower layers
+            if base == WHITEOUT_OPAQUE:
+                merged.remove_tree(parent, keep_self=True)
+            elif base.startswith(WHITEOUT_PREFIX):
+                merged.remove_tree(os.path.join(
+                    parent, base[len(WHITEOUT_PREFIX):]))
+            elif keep(entry.name):
+                layer_entries.append(entry)
+                if on_entry:
+                    on_entry(entry)
+
+        for entry in layer_entries:
+            merged.add(entry)
+
+    return merged.entries
+
+
+# reads the content of the entries of an artifact that were not materialized
+# when it was read (e.g. for the text_content expectations), all the entries
+# asked for at once in one more pass over the artifact; it's picklable to be
+# sent along with the entries to the analysis workers
+class ArchiveContent():
+    def __init__(self, path: str, image: bool = False):
+        self.path = path
+        self.image = image
+
+    # {name: content} of the entries of names, regular files only
+    def read(self, names):
+        names = frozenset(names)
+        if self.image:
+            entries = read_image(self.path, keep=names.__contains__,
+                                 want_content=names.__contains__).values()
+        else:
+            entries = iter_archive(self.path, names.__contains__)
+        return {e.name: e.content for e in entries
+                if e.name in names and e.content is not None}
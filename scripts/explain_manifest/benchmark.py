@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+
+# benchmark of explain_manifest on a synthetic package tree, so the tool can
+# be measured without real Kong packages; the tree is built with the system
+# compiler ($CC, cc by default) and the results are written as JSON to be
+# compared across runs with --compare
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import statistics
+import subprocess
+import contextlib
+import concurrent.futures
+
+import config  # noqa: F401, imported before main
+import main
+import lief
+from explain import ExplainOpts
+from expect import ExpectChain, ExpectSuite
+from suites import common_suites
+
+BENCHMARK_VERSION = 1
+
+NGINX_CONFIGURE = " ".join([
+    "--prefix=/usr/local/openresty/nginx",
+    "--with-cc-opt='-I/work/openssl/include'",
+    "--add-module=../ngx_devel_kit",
+    "--add-module=/work/external/lua-kong-nginx-module",
+    "--add-module=/work/external/lua-kong-nginx-module/stream",
+    "--add-module=/work/distribution/lua-resty-events",
+    "--add-dynamic-module=/work/external/ngx_wasmx_module",
+    "--with-http_ssl_module",
+]) + " "
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output", "-o", default="-",
+                        help="Path to write the results as JSON, use - to write to stdout")
+    parser.add_argument("--work_dir",
+                        help="Directory to generate the tree in, kept after the run; " +
+                        "a temporary directory is used by default")
+    parser.add_argument("--libraries", type=int, default=200,
+                        help="Number of small shared libraries")
+    parser.add_argument("--library_functions", type=int, default=50,
+                        help="Number of functions exported by each shared library")
+    parser.add_argument("--binary_functions", type=int, default=5000,
+                        help="Number of functions of the large binary with DWARF info")
+    parser.add_argument("--text_files", type=int, default=2000,
+                        help="Number of text files")
+    parser.add_argument("--text_size", type=int, default=4096,
+                        help="Size of each text file in bytes")
+    parser.add_argument("--repeat", "-r", type=int, default=3,
+                        help="Number of times each benchmark is run")
+    parser.add_argument("--jobs", "-j", type=int, default=1,
+                        help="Number of processes used to analyze files in parallel")
+    parser.add_argument("--compare", help="Path to the results of a previous run to compare with")
+
+    args = parser.parse_args()
+    if args.libraries < 1:
+        parser.error("at least one library is needed for the large binary to link against")
+    return args
+
+
+def _write(path: str, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb" if isinstance(content, bytes) else "w") as f:
+        f.write(content)
+
+
+def _symlink(target: str, path: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.symlink(target, path)
+
+
+def _cc(args):
+    cc = os.environ.get("CC", "cc")
+    subprocess.run([cc] + args, check=True, stdout=subprocess.DEVNULL)
+
+
+def _library(src_dir: str, root: str, i: int, functions: int):
+    # spread over the directories the real packages install libraries to
+    lib_dir = ("/usr/local/kong/lib", "/usr/local/openresty/lualib",
+               "/usr/local/openresty/site/lualib")[i % 3]
+    name = "libbench%d.so" % i
+    src = os.path.join(src_dir, "bench%d.c" % i)
+    _write(src, "".join(
+        "int bench%d_fn%d(int x) { return x * %d + %d; }\n" % (i, j, i, j)
+        for j in range(functions)))
+
+    os.makedirs(root + lib_dir, exist_ok=True)
+    _cc(["-shared", "-fPIC", "-O1", "-o", os.path.join(root + lib_dir, name + ".1"),
+         "-Wl,-soname," + name + ".1", src])
+    _symlink(name + ".1", os.path.join(root + lib_dir, name))
+
+
+def _nginx(src_dir: str, root: str, functions: int):
+    # the DWARF type looked up by NginxInfo is in its own CU like nginx does
+    request_src = os.path.join(src_dir, "ngx_http_request.c")
+    _write(request_src, "\n".join([
+        "typedef struct ngx_http_request_s { int count; void *data; } ngx_http_request_t;",
+        "ngx_http_request_t *ngx_http_request_current;",
+        "int ngx_http_request_count(ngx_http_request_t *r) { return r->count; }",
+    ]) + "\n")
+
+    main_src = os.path.join(src_dir, "nginx.c")
+    lines = [
+        "#include <stdio.h>",
+        "int bench0_fn0(int x);",
+        'const char *ngx_configure = "%s";' % NGINX_CONFIGURE.replace('"', '\\"'),
+        'const char *ngx_openssl = "built with OpenSSL 3.2.1 30 Jan 2024 (running with ";',
+    ]
+    lines += ["int ngx_bench_fn%d(int x) { return x + %d; }" % (j, j) for j in range(functions)]
+    lines += [
+        "int main(int argc, char **argv) {",
+        "    puts(ngx_configure);",
+        "    puts(ngx_openssl);",
+        "    return ngx_bench_fn0(argc) + bench0_fn0(argc);",
+        "}",
+    ]
+    _write(main_src, "\n".join(lines) + "\n")
+
+    _cc(["-g", "-O0", "-rdynamic", "-o", os.path.join(root, "usr/local/openresty/nginx/sbin/nginx"),
+         main_src, request_src,
+         "-L" + os.path.join(root, "usr/local/kong/lib"), "-l:libbench0.so.1",
+         "-Wl,--disable-new-dtags",
+         "-Wl,-rpath,/usr/local/openresty/luajit/lib:/usr/local/kong/lib:/usr/local/openresty/lualib"])
+
+
+def _text(i: int, size: int):
+    line = "-- synthetic file %d, line of text to fill the file with\n" % i
+    return (line * (size // len(line) + 1))[:size]
+
+
+def _text_files(root: str, count: int, size: int):
+    # paths matched by the globs of filelist.txt and docker_image_filelist.txt
+    fixed = [
+        "etc/kong/kong.conf.default",
+        "etc/kong/kong.logrotate",
+        "etc/passwd",
+        "etc/group",
+        "etc/ssl/certs/ca-certificates.crt",
+        "lib/systemd/system/kong.service",
+        "usr/local/bin/kong",
+        "usr/local/bin/luarocks",
+        "usr/local/etc/luarocks/config-5.1.lua",
+        "usr/local/kong/include/kong/pluginsocket.proto",
+        "usr/local/kong/gui/index.html",
+        "usr/local/share/xml/xsd/schema.xsd",
+    ]
+    for path in fixed:
+        _write(os.path.join(root, path), _text(0, size))
+
+    dirs = [
+        "usr/local/share/lua/5.1/kong/plugins/bench%d",
+        "usr/local/kong/include/google/protobuf/bench%d",
+        "usr/local/kong/include/openssl/bench%d",
+        "usr/local/lib/luarocks/rocks-5.1/bench%d",
+        "usr/local/openresty/lualib/resty/bench%d",
+    ]
+    exts = [".lua", ".proto", ".h", ".rockspec", ".lua"]
+    for i in range(count - len(fixed)):
+        k = i % len(dirs)
+        path = os.path.join(root, dirs[k] % (i // 50), "file%d%s" % (i, exts[k]))
+        _write(path, _text(i, size))
+        if i % 20 == 0:
+            _symlink(os.path.basename(path), path + ".link")
+
+
+def generate(work_dir: str, args):
+    root = os.path.join(work_dir, "root")
+    src_dir = os.path.join(work_dir, "src")
+    shutil.rmtree(root, ignore_errors=True)
+    shutil.rmtree(src_dir, ignore_errors=True)
+    os.makedirs(src_dir)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        futures = [executor.submit(_library, src_dir, root, i, args.library_functions)
+                   for i in range(args.libraries)]
+        for f in futures:
+            f.result()
+
+    os.makedirs(os.path.join(root, "usr/local/openresty/nginx/sbin"))
+    # links against libbench0
+    _nginx(src_dir, root, args.binary_functions)
+    _text_files(root, args.text_files, args.text_size)
+    shutil.rmtree(src_dir)
+
+    files = 0
+    size = 0
+    for dirpath, dirnames, filenames in os.walk(root):
+        files += len(dirnames) + len(filenames)
+        size += sum(os.lstat(os.path.join(dirpath, f)).st_size for f in filenames)
+    return root, {"files": files, "bytes": size}
+
+
+def _time(fn, *args):
+    start = time.perf_counter()
+    r = fn(*args)
+    return r, time.perf_counter() - start
+
+
+def run_benchmarks(root: str, args):
+    globs = main.read_glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), "filelist.txt"))
+    opts = ExplainOpts.from_args(argparse.Namespace(
+        owners=True, mode=True, size=True, arch=True, merge_rpaths_runpaths=False,
+        imported_symbols=True, exported_symbols=True, version_requirement=True))
+    # expectations of the real packages, they don't all pass on the synthetic
+    # tree but the checks done are the same
+    suite = ExpectSuite(name="benchmark", manifest=None, tests={common_suites: {}})
+
+    timings = {"walk_files": [], "write_manifest": [], "expect": []}
+    for _ in range(args.repeat):
+        infos, t = _time(main.walk_files, root, None, args.jobs)
+        timings["walk_files"].append(t)
+
+        manifest, t = _time(main.write_manifest, root, infos, globs, opts)
+        timings["write_manifest"].append(t)
+
+        def expect():
+            E = ExpectChain(infos, exit_on_failure=False)
+            E.compare_manifest(suite, manifest)
+            E.run(suite)
+
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            _, t = _time(expect)
+        timings["expect"].append(t)
+
+    return {name: {
+        "min": min(runs),
+        "median": statistics.median(runs),
+        "mean": statistics.mean(runs),
+        "runs": runs,
+    } for name, runs in timings.items()}
+
+
+def compare(results: dict, baseline: dict, f=sys.stderr):
+    # the size of the binaries depends on the compiler and the build paths
+    corpus = {k: v for k, v in results["corpus"].items() if k != "bytes"}
+    if corpus != {k: v for k, v in baseline.get("corpus", {}).items() if k != "bytes"}:
+        f.write("[WARN] the corpus differs from the baseline, results may not be comparable\n")
+    for name, r in results["results"].items():
+        b = baseline["results"].get(name)
+        if not b:
+            continue
+        f.write("%-16s %8.3fs -> %8.3fs (%.2fx)\n" % (
+            name, b["min"], r["min"], b["min"] / r["min"] if r["min"] else 0))
+
+
+if __name__ == "__main__":
+    args = parse_args()
+
+    work_dir = args.work_dir
+    if not work_dir:
+        import tempfile
+        tmp = tempfile.TemporaryDirectory()
+        work_dir = tmp.name
+
+    root, corpus = generate(work_dir, args)
+    corpus.update({
+        "libraries": args.libraries,
+        "library_functions": args.library_functions,
+        "binary_functions": args.binary_functions,
+        "text_files": args.text_files,
+        "text_size": args.text_size,
+    })
+
+    results = {
+        "version": BENCHMARK_VERSION,
+        "python": platform.python_version(),
+        "lief": lief.__version__,
+        "jobs": args.jobs,
+        "repeat": args.repeat,
+        "corpus": corpus,
+        "results": run_benchmarks(root, args),
+    }
+
+    if args.output == "-":
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare, "r") as f:
+            compare(results, json.load(f))
@@ -0,0 +1,113 @@
+import os
+import sys
+import pickle
+import hashlib
+import tempfile
+import multiprocessing
+
+import lief
+
+# bump this when the facts stored by ElfFileInfo/NginxInfo change
+CACHE_VERSION = 2
+
+# the worker processes of --jobs are started from a fork server (see
+# main.analysis_executor), the counters shared with them must be created in
+# the same context; the server imports the analysis once for all the workers
+worker_context = multiprocessing.get_context("forkserver")
+worker_context.set_forkserver_preload(["config", "main"])
+
+
+# sha256 of the content of a file, hashed in place in its memory map (or
+# bytes); files are hashed once and the digest is used by both the analysis
+# cache and dedup.ContentIndex
+def buffer_digest(buf):
+    return hashlib.sha256(buf).hexdigest()
+
+
+# content addressed on-disk cache of ELF analysis results; entries are keyed
+# by the sha256 of the file content, the tool/lief version and the kind of
+# analysis, so unchanged binaries don't need to be parsed again
+class AnalysisCache():
+    def __init__(self, path, max_size=1024 * 1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+        # shared with the worker processes when running with --jobs
+        self._hits = worker_context.Value("L", 0)
+        self._misses = worker_context.Value("L", 0)
+
+        os.makedirs(path, exist_ok=True)
+
+    @property
+    def hits(self):
+        return self._hits.value
+
+    @property
+    def misses(self):
+        return self._misses.value
+
+    def key(self, digest, kind):
+        return hashlib.sha256(("%d:%s:%s\0%s" % (
+            CACHE_VERSION, lief.__version__, kind, digest)).encode("utf-8")).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, key[:2], key + ".pickle")
+
+    def get(self, key):
+        p = self._entry_path(key)
+        try:
+            with open(p, "rb") as f:
+                facts = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            with self._misses.get_lock():
+                self._misses.value += 1
+            return None
+
+        # entries are evicted by least recent use
+        os.utime(p)
+        with self._hits.get_lock():
+            self._hits.value += 1
+        return facts
+
+    def set(self, key, facts):
+        p = self._entry_path(key)
+        os.makedirs(os.path.dirname(p), exist_ok=True)
+        # write to a temporary file first, other processes and threads may be
+        # reading or writing the same entry
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(p), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(facts, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, p)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def prune(self):
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.path):
+            for name in files:
+                p = os.path.join(root, name)
+                try:
+                    st = os.stat(p)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, p))
+                total += st.st_size
+
+        evicted = 0
+        for _, size, p in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(p)
+            except FileNotFoundError:
+                pass
+            total -= size
+            evicted += 1
+
+        return evicted
+
+    def report(self, f=sys.stderr):
+        f.write("[INFO] analysis cache %s: %d hit(s), %d miss(es)\n" % (
+            self.path, self.hits, self.misses))
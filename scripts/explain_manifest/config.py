@@ -1,11 +1,17 @@
 from copy import deepcopy
 
-from globmatch import glob_match
-
 from main import FileInfo
-from expect import ExpectSuite
+from expect import ExpectSuite, compile_globs
+from resolver import SYSTEM_LIBRARIES
 from suites import common_suites, libc_libcpp_suites, arm64_suites, docker_suites
 
+# targets with libxcrypt without the obsolete API only provide libcrypt.so.2
+libxcrypt_system_libraries = tuple(
+    "libcrypt.so.2" if lib == "libcrypt.so.1" else lib for lib in SYSTEM_LIBRARIES)
+
+
+libxslt_matcher = compile_globs(["**/kong/lib/libxslt.so*", "**/kong/lib/libexslt.so*"])
+
 
 def transform(f: FileInfo):
     # XXX: libxslt uses libtool and it injects some extra rpaths
@@ -14,7 +20,7 @@ def transform(f: FileInfo):
     # It should have no side effect as the extra rpaths are long random
     # paths created by bazel.
 
-    if glob_match(f.path, ["**/kong/lib/libxslt.so*", "**/kong/lib/libexslt.so*"]):
+    if libxslt_matcher(f.path):
         expected_rpath = "/usr/local/kong/lib"
         if f.rpath and expected_rpath in f.rpath:
             f.rpath = expected_rpath
@@ -57,6 +63,7 @@ targets = {
     "amazonlinux-2023-amd64": ExpectSuite(
         name="Amazon Linux 2023 (amd64)",
         manifest="fixtures/amazonlinux-2023-amd64.txt",
+        system_libraries=libxcrypt_system_libraries,
         tests={
             common_suites: {
                 "libxcrypt_no_obsolete_api": True,
@@ -87,6 +94,7 @@ targets = {
         name="Redhat 8 (amd64)",
         manifest="fixtures/el9-amd64.txt",
         use_rpath=True,
+        system_libraries=libxcrypt_system_libraries,
         tests={
             common_suites: {
                 "libxcrypt_no_obsolete_api": True,
@@ -0,0 +1,124 @@
+import re
+import codecs
+import contextlib
+
+from mapping import map_file
+
+# size of the pieces text content is decoded and searched by
+CHUNK_SIZE = 4 * 1024 * 1024
+# a match ending in the last OVERLAP characters of a piece is searched again
+# with the next piece, so matches across pieces up to this length are found
+OVERLAP = 64 * 1024
+
+
+class ContentMatch():
+    # a re.Match detached from the (memory-mapped) buffer it was found in
+    def __init__(self, m):
+        self.re = m.re
+        self._groups = (m.group(0),) + m.groups()
+        self._spans = tuple(m.span(i) for i in range(len(self._groups)))
+        self._groupdict = m.groupdict()
+
+    def group(self, *indexes):
+        if not indexes:
+            return self._groups[0]
+        if len(indexes) == 1:
+            return self[indexes[0]]
+        return tuple(self[i] for i in indexes)
+
+    def __getitem__(self, i):
+        if isinstance(i, str):
+            return self._groupdict[i]
+        return self._groups[i]
+
+    def groups(self, default=None):
+        return tuple(default if g is None else g for g in self._groups[1:])
+
+    def groupdict(self, default=None):
+        return {k: default if v is None else v for k, v in self._groupdict.items()}
+
+    def span(self, i=0):
+        return self._spans[i]
+
+    def start(self, i=0):
+        return self._spans[i][0]
+
+    def end(self, i=0):
+        return self._spans[i][1]
+
+
+# content of a file for the expectations, searched over a memory map or a
+# stream of decoded pieces instead of being read into a single Python object;
+# data is the content when it's already in memory (str or bytes)
+class Content():
+    def __init__(self, name: str, text: bool, path: str = None, data=None):
+        self._name = name
+        self._text = text
+        self._path = path
+        self._data = data
+
+    def __str__(self):
+        return "<%s content of %s>" % ("text" if self._text else "binary", self._name)
+
+    @contextlib.contextmanager
+    def _buffer(self):
+        if self._data is not None:
+            yield self._data.encode("utf-8") if isinstance(self._data, str) else self._data
+            return
+
+        with map_file(self._path) as buf:
+            yield buf
+
+    def _search_bytes(self, regex):
+        with self._buffer() as buf:
+            m = regex.search(buf)
+            return ContentMatch(m) if m else None
+
+    def _search_text(self, regex):
+        if self._data is not None:
+            data = self._data
+            if not isinstance(data, str):
+                data = data.decode("utf-8")
+            return regex.search(data)
+
+        with open(self._path, "rb") as f:
+            decoder = codecs.getincrementaldecoder("utf-8")()
+            window = decoder.decode(f.read(CHUNK_SIZE))
+            pos = 0
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    return regex.search(window + decoder.decode(b"", final=True), pos)
+
+                m = regex.search(window, pos)
+                keep = len(window) - OVERLAP
+                if m and m.end() <= keep:
+                    return m
+                if m:
+                    # might be longer (or not match at all) with more content
+                    keep = min(keep, m.start())
+                keep = max(keep, pos)
+                # the character before the next search position is kept for
+                # lookbehinds and \b, and keeps ^ from matching there
+                start = max(keep - 1, 0)
+                pos = keep - start
+                window = window[start:] + decoder.decode(chunk)
+
+    def search(self, pattern):
+        if self._text:
+            if isinstance(pattern, bytes):
+                pattern = pattern.decode("utf-8")
+            return self._search_text(re.compile(pattern))
+
+        if isinstance(pattern, str):
+            pattern = pattern.encode("utf-8")
+        return self._search_bytes(re.compile(pattern))
+
+    def contains(self, needle):
+        if self._text:
+            return self.search(re.escape(needle)) is not None
+
+        if isinstance(needle, str):
+            needle = needle.encode("utf-8")
+        with self._buffer() as buf:
+            return buf.find(needle) >= 0
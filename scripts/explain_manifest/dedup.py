@@ -0,0 +1,93 @@
+import sys
+import threading
+import concurrent.futures
+
+from cache import buffer_digest
+from mapping import map_file
+
+# index of the current run, see set_content_index; files are not deduplicated
+# when it's not set
+content_index = None
+
+
+def set_content_index(index):
+    global content_index
+    content_index = index
+
+
+# analysis results of ELF files by content digest, shared by the files with
+# the same content within an artifact (e.g. a library under several paths)
+# and across the artifacts explained by the process (e.g. the amd64 and arm64
+# packages of a batch); each file is hashed once, by the process reading the
+# artifacts, and only the first file of each digest is analyzed, the others
+# wait for its analysis even if it's still running for another artifact
+class ContentIndex():
+    def __init__(self):
+        # (kind, digest) -> facts of ElfFileInfo._dump_facts, None if the
+        # file couldn't be analyzed
+        self._facts = {}
+        # (kind, digest) -> Future done once the facts of the first file of
+        # that content are added, while it's being analyzed
+        self._pending = {}
+        # artifacts are read by several threads in batch mode
+        self._lock = threading.Lock()
+        self.hashed = 0
+        self.shared = 0
+
+    def digest(self, full_path: str, entry=None):
+        if entry is not None and entry.content is not None:
+            digest = buffer_digest(entry.content)
+        else:
+            try:
+                with map_file(full_path) as buf:
+                    digest = buffer_digest(buf)
+            except OSError:  # not a regular file, or content not extracted
+                return None
+        with self._lock:
+            self.hashed += 1
+        return digest
+
+    # True if the caller is the first to analyze the content of key, it must
+    # then add its result, or hand its analysis over with add_when_done
+    def claim(self, key):
+        with self._lock:
+            if key in self._facts or key in self._pending:
+                return False
+            self._pending[key] = concurrent.futures.Future()
+            return True
+
+    # facts are taken before config.transform, which depends on the path
+    def add(self, key, info):
+        facts = info._dump_facts() if getattr(info, "arch", None) else None
+        with self._lock:
+            self._facts.setdefault(key, facts)
+            pending = self._pending.pop(key, None)
+        if pending:
+            pending.set_result(None)
+
+    # adds the result of the analysis of the first file of key once future is
+    # done, whoever (if anyone) waits for that future
+    def add_when_done(self, key, future: concurrent.futures.Future):
+        def done(future):
+            failed = future.cancelled() or future.exception() is not None
+            self.add(key, None if failed else future.result())
+
+        future.add_done_callback(done)
+
+    # a new FileInfo of the class of the key with the facts of the first file
+    # of the same content, None if that one couldn't be analyzed
+    def explain(self, key, cls, full_path: str, relpath: str, entry=None):
+        with self._lock:
+            pending = self._pending.get(key)
+        if pending:
+            pending.result()
+        facts = self._facts.get(key)
+        if facts is None:
+            return None
+        with self._lock:
+            self.shared += 1
+        return cls(full_path, relpath, entry, digest=key[1], facts=facts)
+
+    def report(self, f=sys.stderr):
+        f.write("[INFO] content index: %d file(s) hashed, %d analysis result(s) shared\n" % (
+            self.hashed, self.shared))
@@ -0,0 +1,140 @@
+from elftools.elf.elffile import ELFFile
+
+TYPE_TAGS = (
+    "DW_TAG_typedef",
+    "DW_TAG_structure_type",
+    "DW_TAG_union_type",
+    "DW_TAG_enumeration_type",
+    "DW_TAG_class_type",
+    "DW_TAG_base_type",
+)
+
+FUNCTION_TAGS = (
+    "DW_TAG_subprogram",
+)
+
+
+def _die_name(die):
+    attr = die.attributes.get("DW_AT_name")
+    if not attr:
+        return None
+    return attr.value.decode("utf-8", errors="replace")
+
+
+# answers "does the binary define type X / function Y" without decoding every
+# DIE: the accelerator tables (.debug_pubtypes/.debug_pubnames) are used for
+# the CUs they cover, a compact name index is built for the others from the
+# top level DIEs of each CU, following DW_AT_sibling to skip nested DIEs.
+# Only the types and functions declared at the top level of a CU are found,
+# unlike a scan of every DIE name: members of C++ namespaces or classes and
+# types local to a function are not
+class DwarfIndex():
+    def __init__(self, elffile: ELFFile):
+        self._dwarf_info = None
+        if elffile.has_dwarf_info():
+            self._dwarf_info = elffile.get_dwarf_info()
+
+        # kind -> (name -> NameLUTEntry, offsets of the CUs covered)
+        self._accelerators = {}
+        # CU offset -> (CU name, type names, function names)
+        self._cu_index = {}
+
+    def _accelerator(self, kind: str):
+        # NameLUT parses the whole section on first access, use the resulting
+        # dict directly for lookups; a producer may emit the table for some
+        # CUs only (e.g. -gpubnames on part of the objects)
+        if kind not in self._accelerators:
+            if kind == "types":
+                lut = self._dwarf_info.get_pubtypes()
+            else:
+                lut = self._dwarf_info.get_pubnames()
+            if lut:
+                covered = frozenset(h.debug_info_offset for h in lut.get_cu_headers())
+                self._accelerators[kind] = (lut.get_entries(), covered)
+            else:
+                self._accelerators[kind] = ({}, frozenset())
+        return self._accelerators[kind]
+
+    def _is_kind(self, entry, kind: str):
+        # .debug_pubnames also lists global variables and declarations, only
+        # the DIEs referred by the matched entries are decoded to tell them
+        die = self._dwarf_info.get_DIE_from_lut_entry(entry)
+        if kind == "types":
+            return die.tag in TYPE_TAGS
+        return die.tag in FUNCTION_TAGS and "DW_AT_declaration" not in die.attributes
+
+    def _index_cu(self, cu):
+        if cu.cu_offset in self._cu_index:
+            return self._cu_index[cu.cu_offset]
+
+        top = cu.get_top_DIE()
+        types = set()
+        functions = set()
+        for die in top.iter_children():
+            name = _die_name(die)
+            if not name:
+                continue
+            if die.tag in TYPE_TAGS:
+                types.add(name)
+            elif die.tag in FUNCTION_TAGS and "DW_AT_declaration" not in die.attributes:
+                functions.add(name)
+
+        r = (_die_name(top) or "", frozenset(types), frozenset(functions))
+        self._cu_index[cu.cu_offset] = r
+        return r
+
+    def _in_cu(self, cu, cu_name: str):
+        # only the top DIE is needed to filter by the CU name
+        return not cu_name or cu_name in (_die_name(cu.get_top_DIE()) or "")
+
+    def _iter_index(self, cu_name: str = None, skip=frozenset()):
+        for cu in self._dwarf_info.iter_CUs():
+            if cu.cu_offset not in skip and self._in_cu(cu, cu_name):
+                yield self._index_cu(cu)
+
+    def _has(self, kind: str, name: str, cu_name: str = None):
+        if not self._dwarf_info:
+            return False
+
+        entries, covered = self._accelerator(kind)
+        entry = entries.get(name)
+        if entry is not None:
+            if self._is_kind(entry, kind) and \
+                    self._in_cu(self._dwarf_info.get_CU_at(entry.cu_ofs), cu_name):
+                return True
+            # the table keeps a single entry per name, the other CUs
+            # defining it are not known
+            covered = frozenset()
+
+        i = 1 if kind == "types" else 2
+        for entry in self._iter_index(cu_name, skip=covered):
+            if name in entry[i]:
+                return True
+        return False
+
+    def _names(self, kind: str):
+        if not self._dwarf_info:
+            return []
+
+        entries, covered = self._accelerator(kind)
+        names = set(name for name, entry in entries.items()
+                    if self._is_kind(entry, kind))
+
+        i = 1 if kind == "types" else 2
+        for entry in self._iter_index(skip=covered):
+            names.update(entry[i])
+        return sorted(names)
+
+    # cu_name limits the lookup to the CUs whose name contains it, to avoid
+    # indexing the whole binary for the CUs the accelerator tables miss
+    def has_type(self, name: str, cu_name: str = None):
+        return self._has("types", name, cu_name)
+
+    def has_function(self, name: str, cu_name: str = None):
+        return self._has("functions", name, cu_name)
+
+    def types(self):
+        return self._names("types")
+
+    def functions(self):
+        return self._names("functions")
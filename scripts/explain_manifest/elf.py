@@ -0,0 +1,153 @@
+import struct
+
+ELF_MAGIC = b"\x7fELF"
+
+ELFCLASS32 = 1
+ELFCLASS64 = 2
+ELFDATA2LSB = 1
+ELFDATA2MSB = 2
+
+PT_LOAD = 1
+PT_DYNAMIC = 2
+
+DT_NULL = 0
+DT_NEEDED = 1
+DT_STRTAB = 5
+DT_STRSZ = 10
+DT_RPATH = 15
+DT_RUNPATH = 29
+DT_VERNEED = 0x6ffffffe
+DT_VERNEEDNUM = 0x6fffffff
+
+
+class DynamicInfo():
+    __slots__ = ("machine", "needed_libraries", "rpath",
+                 "runpath", "version_requirement")
+
+    def __init__(self, machine):
+        self.machine = machine
+        self.needed_libraries = []
+        self.rpath = None
+        self.runpath = None
+        # library -> list of required version names
+        self.version_requirement = {}
+
+
+class _Reader():
+    def __init__(self, f, elf_class, endian):
+        self.f = f
+        self.is64 = elf_class == ELFCLASS64
+        self.endian = "<" if endian == ELFDATA2LSB else ">"
+
+    def unpack(self, fmt, offset):
+        fmt = self.endian + fmt
+        self.f.seek(offset)
+        data = self.f.read(struct.calcsize(fmt))
+        return struct.unpack(fmt, data)
+
+    def cstring(self, offset):
+        self.f.seek(offset)
+        data = b""
+        while True:
+            chunk = self.f.read(256)
+            if not chunk:
+                raise ValueError("unterminated string at %d" % offset)
+            end = chunk.find(b"\0")
+            if end >= 0:
+                return (data + chunk[:end]).decode("utf-8", errors="surrogateescape")
+            data += chunk
+
+
+def _vaddr_to_offset(loads, vaddr):
+    for p_offset, p_vaddr, p_filesz in loads:
+        if p_vaddr <= vaddr < p_vaddr + p_filesz:
+            return vaddr - p_vaddr + p_offset
+    raise ValueError("address 0x%x is not mapped" % vaddr)
+
+
+# reads only the ELF header, the program headers, the dynamic segment, its
+# string table and the version needs (.gnu.version_r) to get the facts the
+# manifest needs without parsing the symbol tables; returns None if the file
+# is not an ELF file or is not understood, callers should then fall back to
+# a full parse
+def read_dynamic_info(f):
+    try:
+        return _read_dynamic_info(f)
+    except (ValueError, struct.error):
+        return None
+
+
+def _read_dynamic_info(f):
+    f.seek(0)
+    ident = f.read(16)
+    if len(ident) < 16 or ident[:4] != ELF_MAGIC:
+        return None
+    if ident[4] not in (ELFCLASS32, ELFCLASS64) or ident[5] not in (ELFDATA2LSB, ELFDATA2MSB):
+        return None
+
+    r = _Reader(f, ident[4], ident[5])
+    if r.is64:
+        (_, e_machine, _, _, e_phoff, _, _, _, e_phentsize, e_phnum,
+         _, _, _) = r.unpack("HHIQQQIHHHHHH", 16)
+        phdr_fmt = "IIQQQQQQ"
+    else:
+        (_, e_machine, _, _, e_phoff, _, _, _, e_phentsize, e_phnum,
+         _, _, _) = r.unpack("HHIIIIIHHHHHH", 16)
+        phdr_fmt = "IIIIIIII"
+
+    info = DynamicInfo(e_machine)
+
+    loads = []
+    dynamic = None
+    for i in range(e_phnum):
+        phdr = r.unpack(phdr_fmt, e_phoff + i * e_phentsize)
+        if r.is64:
+            p_type, _, p_offset, p_vaddr, _, p_filesz, _, _ = phdr
+        else:
+            p_type, p_offset, p_vaddr, _, p_filesz, _, _, _ = phdr
+        if p_type == PT_LOAD:
+            loads.append((p_offset, p_vaddr, p_filesz))
+        elif p_type == PT_DYNAMIC:
+            dynamic = (p_offset, p_filesz)
+
+    if not dynamic:
+        return info  # statically linked
+
+    dyn_fmt = "qQ" if r.is64 else "iI"
+    dyn_size = struct.calcsize(dyn_fmt)
+    entries = []
+    for i in range(dynamic[1] // dyn_size):
+        tag, val = r.unpack(dyn_fmt, dynamic[0] + i * dyn_size)
+        if tag == DT_NULL:
+            break
+        entries.append((tag, val))
+
+    tags = dict(entries)
+    if DT_STRTAB not in tags:
+        return info
+    strtab = _vaddr_to_offset(loads, tags[DT_STRTAB])
+
+    for tag, val in entries:
+        if tag == DT_NEEDED:
+            info.needed_libraries.append(r.cstring(strtab + val))
+        elif tag == DT_RPATH:
+            info.rpath = r.cstring(strtab + val)
+        elif tag == DT_RUNPATH:
+            info.runpath = r.cstring(strtab + val)
+
+    if DT_VERNEED in tags:
+        offset = _vaddr_to_offset(loads, tags[DT_VERNEED])
+        for _ in range(tags.get(DT_VERNEEDNUM, 0)):
+            _, vn_cnt, vn_file, vn_aux, vn_next = r.unpack("HHIII", offset)
+            versions = []
+            aux = offset + vn_aux
+            for _ in range(vn_cnt):
+                _, _, _, vna_name, vna_next = r.unpack("IHHII", aux)
+                versions.append(r.cstring(strtab + vna_name))
+                aux += vna_next
+            info.version_requirement[r.cstring(strtab + vn_file)] = versions
+            if not vn_next:
+                break
+            offset += vn_next
+
+    return info
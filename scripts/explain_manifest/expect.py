@@ -2,27 +2,117 @@ import os
 import re
 import sys
 import time
+import bisect
+import functools
 import atexit
 import difflib
 import inspect
 import datetime
-import subprocess
+import json
 from inspect import getframeinfo
 
-from globmatch import glob_match
+from globmatch.translation import translate_glob
 
 import suites
+import profiling
+from content import Content
+from explain import read_contents
+from symbols import SymbolList
+from resolver import SYSTEM_LIBRARIES, LibraryResolver
+from plan import Check, ExistCheck, ExpectPlan, Rule
+from manifest import ManifestDiff, format_diff, format_manifest, load_records
+
+
+@functools.lru_cache(maxsize=None)
+def _compile_globs(globs):
+    # all patterns are joined into one regex, so a path is matched once
+    # instead of once per pattern
+    regex = "|".join("(?:%s)" % translate_glob(os.path.normcase(g[1:] if g.startswith("/") else g))
+                     for g in globs)
+    return re.compile(regex or "(?!)").match
+
+
+def compile_globs(globs):
+    match = _compile_globs(tuple(globs))
+
+    def matcher(path):
+        if path.startswith("/"):
+            path = path[1:]
+        return match(os.path.normcase(path)) is not None
+    return matcher
 
 
 def glob_match_ignore_slash(path, globs):
-    if path.startswith("/"):
-        path = path[1:]
-    globs = list(globs)
-    for i, g in enumerate(globs):
-        if g.startswith("/"):
-            globs[i] = g[1:]
+    return compile_globs(globs)(path)
+
 
-    return glob_match(path, globs)
+def _has_magic(part):
+    return any(c in part for c in "*?[")
+
+
+# index of the analyzed files to find the candidates of a glob without
+# matching every path: patterns with a literal directory prefix are looked up
+# in the sorted paths, "**/*.ext" like patterns by the file extension and
+# "**/name" like patterns by the file name
+class PathIndex():
+    def __init__(self, infos):
+        self._relpaths = [f.relpath for f in infos]
+        self._paths = sorted((p.lstrip("/"), i)
+                             for i, p in enumerate(self._relpaths))
+        self._keys = [p for p, _ in self._paths]
+        self._by_ext = {}
+        self._by_name = {}
+        for i, p in enumerate(self._relpaths):
+            name = p.rpartition("/")[2]
+            if "." in name:
+                self._by_ext.setdefault(name[name.rfind("."):], []).append(i)
+            self._by_name.setdefault(name, []).append(i)
+        self._count = len(infos)
+
+    # returns the candidates and whether they all match the glob
+    def _candidates(self, glob):
+        parts = glob.lstrip("/").split("/")
+        prefix = []
+        for part in parts:
+            if _has_magic(part):
+                break
+            prefix.append(part)
+
+        if len(prefix) == len(parts):
+            # literal path, trailing slashes are allowed by globmatch
+            key = "/".join(prefix).rstrip("/")
+            lo = bisect.bisect_left(self._keys, key)
+            hi = bisect.bisect_right(self._keys, key, lo)
+            return [i for _, i in self._paths[lo:hi]], True
+        elif prefix:
+            key = "/".join(prefix) + "/"
+            lo = bisect.bisect_left(self._keys, key)
+            # "0" is the character right after "/"
+            hi = bisect.bisect_left(self._keys, key[:-1] + "0", lo)
+            # everything under the prefix matches "<prefix>/**"
+            return [i for _, i in self._paths[lo:hi]], parts[len(prefix):] == ["**"]
+
+        m = re.fullmatch(r"\*(\.[^*?\[./]+)", parts[-1])
+        if m and all(p == "**" for p in parts[:-1]):
+            # a single "*.ext" only matches at the top level
+            return self._by_ext.get(m.group(1), []), len(parts) > 1
+        if len(parts) > 1 and parts[0] == "**" and parts[-1] and not any(map(_has_magic, parts[1:])):
+            return self._by_name.get(parts[-1], []), False
+
+        return range(self._count), False
+
+    def match(self, globs, matcher):
+        # returns the positions of the files matching globs, in the original
+        # order; matcher (of compile_globs) is only called for the candidates
+        # that may not match
+        matched = set()
+        candidates = set()
+        for g in globs:
+            c, exact = self._candidates(g)
+            (matched if exact else candidates).update(c)
+        candidates -= matched
+        matched.update(i for i in candidates if matcher(self._relpaths[i]))
+        return sorted(matched)
 
 
 def write_color(color):
@@ -54,7 +144,8 @@ def write_block_desc(desc_verb):
             ExpectChain._log("[INFO] start to %s of suite %s" %
                              (desc_verb, suite.name))
             start_time = time.time()
-            r = fn(self, suite, *args)
+            with profiling.phase(desc_verb):
+                r = fn(self, suite, *args)
             duration = time.time() - start_time
             ExpectChain._log("[INFO] finish to %s of suite %s in %.2fms" % (
                 desc_verb, suite.name, duration*1000))
@@ -63,35 +154,82 @@ def write_block_desc(desc_verb):
     return decorator
 
 
+# content attributes are searched in place instead of being read, see
+# FileInfo.content
+CONTENT_ATTRS = ("text_content", "binary_content")
+# attributes of ELF files computed from the whole tree, see resolver.py
+LIBRARY_ATTRS = ("unresolved_libraries", "library_closure", "library_depth")
+
+
 class ExpectSuite():
-    def __init__(self, name, manifest, use_rpath=False, tests={}):
+    # system_libraries are the libraries the target provides, defaults to
+    # resolver.SYSTEM_LIBRARIES
+    def __init__(self, name, manifest, use_rpath=False, tests={}, system_libraries=SYSTEM_LIBRARIES):
         self.name = name
         self.manifest = manifest
         self.use_rpath = use_rpath
         self.tests = tests
+        self.system_libraries = system_libraries
+
+
+# a diff against the manifest of the suite, None if it has none
+def manifest_diff(suite: ExpectSuite):
+    if not suite.manifest:
+        return None
+
+    try:
+        with open(suite.manifest, "r") as f:
+            if suite.manifest.endswith(".jsonl"):
+                expected = format_manifest(load_records(f)).decode("utf-8")
+            else:
+                expected = f.read()
+    except FileNotFoundError:
+        expected = ""  # compare against an empty manifest like `diff -N`
+    return ManifestDiff(expected)
 
 
 class ExpectChain():
-    def __init__(self, infos):
+    # with changed_paths, only the expectations of files matching one of
+    # them are run, the others are skipped (see watch.py)
+    def __init__(self, infos, exit_on_failure=True, changed_paths=None):
         self._infos = infos
+        self._index = PathIndex(infos)
+        self._resolver = None
+        # expectations recorded by the suites of run, see plan.py
+        self._plan = None
+        self._rule = None
+        self._last_match = None
+        self._changed_paths = changed_paths
+        # failures of each expectation run, by title
+        self._results = {}
         self._all_failures = []
         self._reset()
         self.verbs = ("does_not", "equal", "match", "contain",
-                      "contain_match", "less_than", "greater_than")
-        atexit.register(self._print_all_fails)
+                      "contain_match", "contain_all", "contain_none",
+                      "less_than", "greater_than")
+        # in batch mode the caller collects the failures of each chain with
+        # failures() and reports them all at once
+        if exit_on_failure:
+            atexit.register(self._print_all_fails)
 
     def _reset(self):
         # clear states
         self._logical_reverse = False
+        self._key_name = None
         self._files = []
         self._msg = ""
         self._title_shown = False
         self._checks_count = 0
         self._failures_count = 0
         self._last_attribute = None
-
-    def _ctx_info(self):
-        f = inspect.currentframe().f_back.f_back.f_back.f_back
+        self._title = None
+        self._skipped = False
+
+    # file:line of the frame depth levels above the caller of _ctx_info
+    def _ctx_info(self, depth=3):
+        f = inspect.currentframe().f_back
+        for _ in range(depth):
+            f = f.f_back
         fn_rel = os.path.relpath(getframeinfo(f).filename, os.getcwd())
 
         return "%s:%d" % (fn_rel, f.f_lineno)
@@ -105,13 +243,16 @@ class ExpectChain():
     def _print_title(self):
         if self._title_shown:
             return
-        self._log("[TEST] %s: %s" % (self._ctx_info(), self._msg))
+        self._log("[TEST] %s" % self._title)
         self._title_shown = True
 
     @write_color("red")
-    def _print_fail(self, msg):
+    def _print_fail(self, msg, ctx=None):
         self._log("[FAIL] %s" % msg)
-        self._all_failures.append("%s: %s" % (self._ctx_info(), msg))
+        failure = "%s: %s" % (ctx or self._ctx_info(), msg)
+        self._all_failures.append(failure)
+        if self._title:
+            self._results[self._title].append(failure)
         self._failures_count += 1
 
     @write_color("green")
@@ -142,38 +283,43 @@ class ExpectChain():
                 "Following failure(s) occurred:\n" + "\n".join(self._all_failures))
             os._exit(1)
 
+    def _get_resolver(self):
+        system_libraries = self._current_suite.system_libraries
+        if not self._resolver or self._resolver.system_libraries != frozenset(system_libraries):
+            # symlinks to ELF files are not in the infos, see main.explain_files
+            self._resolver = LibraryResolver(
+                self._infos, getattr(self._infos, "symlinks", None), system_libraries)
+        return self._resolver
+
+    # None if the attribute doesn't apply to the file, see ExpectPlan._visit
+    def _has_attr(self, f, attr):
+        if attr in CONTENT_ATTRS:
+            if f.has_content():
+                return True
+            # directories and symlinks of archives have no content
+            return None if hasattr(f, "directory") or hasattr(f, "link") else False
+        elif attr in LIBRARY_ATTRS:
+            return hasattr(f, "needed_libraries")
+        return hasattr(f, attr)
+
+    def _value(self, f, attr):
+        if attr in CONTENT_ATTRS:
+            return f.content(attr)
+        elif attr in LIBRARY_ATTRS:
+            return self._get_resolver().attribute(f, attr)
+        return getattr(f, attr)
+
+    # verbs are recorded into the plan and checked once all the
+    # expectations of the suite are, see run
     def _compare(self, attr, fn):
-        self._checks_count += 1
-        results = []
-        for f in self._files:
-            if not hasattr(f, attr):
-                continue  # accept missing attribute for now
-            v = getattr(f, attr)
-            if self._key_name and isinstance(v, dict):
-                # TODO: explicit flag to accept missing key
-                if self._key_name not in v:
-                    return True
-                v = v[self._key_name]
-            (r, err_template) = fn(v)
-            if r:
-                results.append(r)
-            if (not not r) == self._logical_reverse:
-                _not = "not"
-                if self._logical_reverse:
-                    _not = "actually"
-
-                self._print_fail("file %s <%s>: %s" % (
-                    f.relpath, attr, err_template.format(v, NOT=_not)
-                ))
-                return False
-        return results
+        check = Check(self._verb_name, attr, fn, self._logical_reverse, self._key_name,
+                      self._ctx_info(1))
+        return self._rule.add(check)
 
     def _exist(self):
-        self._checks_count += 1
-        matched_files_count = len(self._files)
-        if (matched_files_count > 0) == self._logical_reverse:
-            self._print_fail("found %d files matching %s" % (
-                matched_files_count, self._path_glob))
+        if self._skipped:
+            return self
+        self._rule.add(ExistCheck(self._path_glob, self._logical_reverse, self._ctx_info(1)))
         return self
 
     # following are verbs
@@ -182,9 +328,12 @@ class ExpectChain():
         return self._compare(attr, lambda a: (a == expect, "'{}' does {NOT} equal to '%s'" % expect))
 
     def _match(self, attr, expect):
-        r = self._compare(attr, lambda a: (re.search(expect, a), "'{}' does {NOT} match '%s'" % expect))
-        self.last_macthes = r
-        return (not not r)
+        def search(a):
+            if isinstance(a, Content):
+                return a.search(expect)
+            return re.search(expect, a)
+        self._last_match = (self._rule, self._compare(
+            attr, lambda a: (search(a), "'{}' does {NOT} match '%s'" % expect)))
 
     def _less_than(self, attr, expect):
         def fn(a):
@@ -204,24 +353,69 @@ class ExpectChain():
             return ll > expect, "'{}' is {NOT} greater than %s" % expect
         return self._compare(attr, fn)
 
+    def _closest(self, a, expect):
+        if isinstance(a, SymbolList):
+            closest = a.close_matches(expect, 1)
+        else:
+            closest = difflib.get_close_matches(expect, a, 1)
+        return closest[0] if closest else None
+
     def _contain(self, attr, expect):
         def fn(a):
-            if isinstance(a, list):
+            if isinstance(a, Content):
+                return a.contains(expect), "'%s' is {NOT} found in {}" % expect
+            elif isinstance(a, list):
                 ok = expect in a
                 msg = "'%s' is {NOT} found in the list" % expect
                 if not ok:
                     if len(a) == 0:
                         msg = "'%s' is empty" % attr
                     else:
-                        closest = difflib.get_close_matches(expect, a, 1)
-                        if len(closest) > 0:
-                            msg += ", did you mean '%s'?" % closest[0]
+                        closest = self._closest(a, expect)
+                        if closest:
+                            msg += ", did you mean '%s'?" % closest
                 return ok, msg
             else:
                 return False, "%s is not a list" % attr
             # should not reach here
         return self._compare(attr, fn)
 
+    # following verbs take a list of values and check them all in one pass,
+    # every missing (or unexpected) value is reported in the same failure
+
+    def _contain_all(self, attr, expect):
+        def fn(a):
+            if not isinstance(a, list):
+                return False, "'%s' is not a list" % attr
+            if len(a) == 0:
+                return False, "'%s' is empty" % attr
+
+            values = a if isinstance(a, SymbolList) else set(a)
+            missing = [e for e in expect if e not in values]
+            if not missing:
+                return True, "all %d value(s) are {NOT} found in the list" % len(expect)
+
+            items = []
+            for e in missing:
+                closest = self._closest(a, e)
+                items.append("'%s'%s" % (e, " (did you mean '%s'?)" % closest if closest else ""))
+            return False, "%d/%d value(s) are {NOT} found in the list: %s" % (
+                len(missing), len(expect), ", ".join(items))
+        return self._compare(attr, fn)
+
+    def _contain_none(self, attr, expect):
+        def fn(a):
+            if not isinstance(a, list):
+                return False, "'%s' is not a list" % attr
+
+            values = a if isinstance(a, SymbolList) else set(a)
+            found = [e for e in expect if e in values]
+            if not found:
+                return True, "none of the %d value(s) is found in the list" % len(expect)
+            return False, "%d/%d value(s) are unexpectedly found in the list: %s" % (
+                len(found), len(expect), ", ".join("'%s'" % e for e in found))
+        return self._compare(attr, fn)
+
     def _contain_match(self, attr, expect):
         def fn(a):
             if isinstance(a, list):
@@ -241,20 +435,21 @@ class ExpectChain():
         return self
 
     def expect(self, path_glob, msg):
-        # lazy print last test result
-        self._print_result()
         # reset states
         self._reset()
 
-        self._msg = msg
-        self._print_title()
-
         self._path_glob = path_glob
         if isinstance(path_glob, str):
             self._path_glob = [path_glob]
-        for f in self._infos:
-            if glob_match_ignore_slash(f.relpath, self._path_glob):
-                self._files.append(f)
+        matcher = compile_globs(self._path_glob)
+        if self._changed_paths is not None and not any(map(matcher, self._changed_paths)):
+            self._skipped = True
+            self._rule = self._plan.add(Rule(self._path_glob, None, skipped=True))
+            return self
+
+        self._msg = msg
+        self._title = "%s: %s" % (self._ctx_info(1), msg)
+        self._rule = self._plan.add(Rule(self._path_glob, self._title))
         return self
 
     def do_not(self):
@@ -295,49 +490,152 @@ class ExpectChain():
             self._key_name = None
             return self
 
+        # the matches of a skipped expectation are still recorded, the suite
+        # may read them back to record the others (see get_last_macthes)
+        if self._skipped and verb != "match":
+            return dummy_call
+
         if not self._last_attribute:
-            self._print_error("attribute is not set before verb \"%s\"" % name)
+            self._rule.add("attribute is not set before verb \"%s\"" % name)
             return dummy_call
 
         attr = self._last_attribute
-        for f in self._files:
-            if not hasattr(f, attr):
-                self._print_error(
-                    "\"%s\" expect \"%s\" attribute to be present, but it's absent for %s (a %s)" % (
-                    name, attr, f.relpath, type(f)))
-                return dummy_call
 
         def cls(expect):
+            self._verb_name = name
             getattr(self, "_%s" % verb)(attr, expect)
             return self
 
         return cls
 
     @write_block_desc("compare manifest")
-    def compare_manifest(self, suite: ExpectSuite, manifest: str):
+    def compare_manifest(self, suite: ExpectSuite, manifest: bytes, diff_format: str = "text"):
         self._current_suite = suite
 
-        if not suite.manifest:
-            return
+        diff = manifest_diff(suite)
+        if diff is None:
+            return []
+        diff.add(manifest.decode("utf-8"))
+        return self._report_manifest_diff(diff.changes(), diff_format)
+
+    # same as compare_manifest with a diff the manifest was added to while it
+    # was written, see main.stream_manifest
+    @write_block_desc("compare manifest")
+    def report_manifest_diff(self, suite: ExpectSuite, diff: ManifestDiff, diff_format: str = "text"):
+        self._current_suite = suite
+
+        if diff is None:
+            return []
+        return self._report_manifest_diff(diff.changes(), diff_format)
 
-        diff_result = subprocess.run(
-            ['diff', "-BbNaur", suite.manifest, '-'], input=manifest, stdout=subprocess.PIPE)
-        if diff_result.returncode != 0:
+    def _report_manifest_diff(self, changes, diff_format):
+        if changes:
             self._print_fail("manifest is not up-to-date:")
-            if diff_result.stdout:
-                print(diff_result.stdout.decode())
-            if diff_result.stderr:
-                print(diff_result.stderr.decode())
+            if diff_format == "json":
+                print(json.dumps(changes, indent=2))
+            else:
+                print(format_diff(changes))
+        return changes
 
     @write_block_desc("run test suite")
     def run(self, suite: ExpectSuite):
         self._current_suite = suite
 
-        for s in suite.tests:
-            s(self.expect, **suite.tests[s])
-
-        self._print_result()  # cleanup the lazy buffer
-
-
+        self._plan = ExpectPlan(self._infos, self._index, self._has_attr, self._value)
+        try:
+            # the expectations recorded before a suite fails are still run
+            for s in suite.tests:
+                s(self.expect, **suite.tests[s])
+        finally:
+            self._read_contents(r for r in self._plan.rules if not r.skipped)
+            self._plan.execute(compile_globs)
+            self._report_plan()
+            self._plan = None
+            self._rule = None
+            self._last_match = None
+
+        self._report_load_closure("**/sbin/nginx")
+
+    # the content of the files of archives matched by content checks is read
+    # again from the artifacts, at once before the checks
+    def _read_contents(self, rules):
+        files = []
+        for rule in rules:
+            if any(isinstance(s, Check) and s.attr in CONTENT_ATTRS and not s.evaluated
+                   for s in rule.steps):
+                files.extend(self._infos[i] for i in self._index.match(rule.globs, compile_globs(rule.globs)))
+        read_contents(files)
+
+    # prints the results of the plan in the order the expectations were
+    # recorded, the same as if they were checked one after the other
+    def _report_plan(self):
+        for rule in self._plan.rules:
+            self._reset()
+            if rule.skipped:
+                continue
+
+            self._title = rule.title
+            self._files = rule.files
+            self._print_title()
+            self._results[self._title] = []
+            for step in rule.steps:
+                if isinstance(step, str):
+                    self._print_error(step)
+                elif isinstance(step, ExistCheck):
+                    self._checks_count += 1
+                    if (len(rule.files) > 0) == step.reverse:
+                        self._print_fail("found %d files matching %s" % (
+                            len(rule.files), step.path_glob), step.ctx)
+                elif step.missing:
+                    f = step.missing
+                    msg = "\"%s\" expect \"%s\" attribute to be present, but it's absent for %s (a %s)" % (
+                        step.name, step.attr, f.relpath, type(f))
+                    if step.attr in CONTENT_ATTRS:
+                        # the content can't be checked, it's not a pass
+                        self._checks_count += 1
+                        self._print_fail(msg, step.ctx)
+                    else:
+                        self._print_error(msg)
+                else:
+                    self._checks_count += 1
+                    if step.failure:
+                        self._print_fail(step.failure, step.ctx)
+            self._print_result()
+
+            if profiling.profiler:
+                profiling.profiler.add("expect %s" % self._title, *rule.timing)
+
+    def _report_load_closure(self, path_glob):
+        matcher = compile_globs([path_glob])
+        if self._changed_paths is not None and not any(map(matcher, self._changed_paths)):
+            return
+        for i in self._index.match([path_glob], matcher):
+            f = self._infos[i]
+            if not hasattr(f, "needed_libraries"):
+                continue
+            closure = self._get_resolver().closure(f)
+            self._log("[INFO] load closure of %s: %d libraries, depth %d" % (
+                f.relpath, len(closure.libraries), closure.depth))
+            for name, path, depth in closure.libraries:
+                print("  %s%s => %s" % ("  " * (depth - 1), name, path or "(system)"))
+            for name in closure.unresolved:
+                print("  %s => not found" % name)
+
+
+    # {title: failures} of the expectations that were not skipped
+    def results(self):
+        return self._results
+
+    def failures(self):
+        return list(self._all_failures)
+
+    # checks the last match right away, its results are needed by the suite
+    # to record the next expectations
     def get_last_macthes(self):
-        return self.last_macthes
+        if self._last_match is None:
+            return []
+        rule, check = self._last_match
+        if not check.evaluated:
+            self._read_contents([rule])
+            self._plan.evaluate(rule, check, compile_globs(rule.globs))
+        return check.results
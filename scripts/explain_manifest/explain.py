@@ -1,26 +1,87 @@
 
+import io
 import os
 import re
+import mmap
+import weakref
+import contextlib
+import collections
 from pathlib import Path
 
 import lief
 from looseversion import LooseVersion
 from elftools.elf.elffile import ELFFile
 
-caches = {}
+from elf import read_dynamic_info
+from cache import buffer_digest
+from mapping import BufferReader, map_file
+from content import Content
+from symbols import SymbolList
+from dwarf import DwarfIndex
 
+# persistent cache of ELF analysis results, see cache.py
+analysis_cache = None
 
-def lazy_evaluate_cache():
-    def decorator(fn):
-        def wrapper(self, name):
-            key = (self, name)
-            if key in caches:
-                return caches[key]
-            r = fn(self, name)
-            caches[key] = r
-            return r
-        return wrapper
-    return decorator
+
+def set_analysis_cache(cache):
+    global analysis_cache
+    analysis_cache = cache
+
+
+def _sizeof(v):
+    # rough estimation, good enough to bound the memory
+    if isinstance(v, (bytes, str)):
+        return len(v)
+    elif isinstance(v, (list, tuple, set, frozenset)):
+        return sum(_sizeof(i) for i in v) + 8 * len(v)
+    return 64
+
+
+# bounds the memory held by the lazily evaluated attributes (file content,
+# symbol lists, etc.) of all FileInfo of the process; the least recently used
+# values are dropped and evaluated again when they are accessed next time
+class LazyValues():
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        # (id(owner), name) -> (weakref to owner, size)
+        self._entries = collections.OrderedDict()
+
+    def add(self, owner, name, value):
+        key = (id(owner), name)
+        self._forget(key)
+        size = _sizeof(value)
+        # the key is bound now, not when the owner is collected
+        self._entries[key] = (weakref.ref(owner, lambda _, key=key: self._forget(key)), size)
+        self.size += size
+
+        while self.size > self.max_size and len(self._entries) > 1:
+            oldest, (ref, _) = next(iter(self._entries.items()))
+            self._forget(oldest)
+            victim = ref()
+            if victim is not None:
+                victim._lazy_evaluate_cache.pop(oldest[1], None)
+
+    def touch(self, owner, name):
+        key = (id(owner), name)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+
+    def _forget(self, key):
+        entry = self._entries.pop(key, None)
+        if entry:
+            self.size -= entry[1]
+
+
+lazy_values = LazyValues(512 * 1024 * 1024)
+
+
+def set_lazy_values_max_size(max_size):
+    lazy_values.max_size = max_size
+
+
+# tells a lazily evaluated None apart from a value that is not evaluated yet
+_NOT_EVALUATED = object()
 
 
 class ExplainOpts():
@@ -50,13 +111,42 @@ class ExplainOpts():
 
 
 class FileInfo():
-    def __init__(self, path, relpath):
+    def __init__(self, path, relpath, entry=None):
         self.path = path
         self.relpath = relpath
 
         self._lazy_evaluate_cache = {}
         self._lazy_evaluate_attrs = {}
 
+        # files streamed from a package don't exist on disk, their metadata
+        # and (optionally) content come from the archive entry instead; files
+        # of a directory tree come with the entry from a single lstat
+        self._in_archive = entry is not None and not entry.on_disk
+        # where the content of a file of an archive is read again from when
+        # it's not in memory, see read_contents
+        self._source = entry.source if entry is not None else None
+        # memory map of the file while it's being analyzed, see _mapped
+        self._map = None
+        self._reading = False
+
+        if entry is not None:
+            if entry.is_symlink():
+                self.link = entry.link
+            elif entry.is_dir():
+                self.directory = True
+
+            self.mode = entry.mode
+            self.file_mode = '0' + oct(self.mode & 0o777)[2:]
+            self.uid = entry.uid
+            self.gid = entry.gid
+
+            if not entry.is_symlink():
+                self.size = entry.size
+
+            self._hold_content(entry)
+            self._register_lazy_attrs()
+            return
+
         if Path(path).is_symlink():
             self.link = os.readlink(path)
         elif Path(path).is_dir():
@@ -72,21 +162,126 @@ class FileInfo():
         if not Path(path).is_symlink():
             self.size = os.stat(path).st_size
 
+        self._register_lazy_attrs()
+
+    # the content is mapped once for all the readers opened within the
+    # outermost _mapped, instead of each of them reading its own copy
+    @contextlib.contextmanager
+    def _mapped(self):
+        if self._in_archive:
+            data = self._lazy_evaluate_cache.get("binary_content")
+            if data is None:
+                data = self._source.read([self.relpath[1:]])[self.relpath[1:]]
+                self._set_lazy_value("binary_content", data)
+            yield data
+        elif self._map is not None:
+            yield self._map
+        else:
+            with map_file(self.path) as m:
+                self._map = m
+                try:
+                    yield m
+                finally:
+                    self._map = None
+
+    # the map (or the bytes, which BytesIO doesn't copy) is read directly by
+    # the first reader, pyelftools does a read call for each field parsed and
+    # those of mmap and BytesIO are much cheaper than a Python one; readers
+    # opened while it's in use get their own position over the same buffer
+    @contextlib.contextmanager
+    def _open(self):
+        with self._mapped() as buf:
+            if self._reading:
+                with BufferReader(buf) as f:
+                    yield f
+                return
+
+            self._reading = True
+            try:
+                if isinstance(buf, mmap.mmap):
+                    buf.seek(0)
+                    yield buf
+                else:
+                    with io.BytesIO(buf) as f:
+                        yield f
+            finally:
+                self._reading = False
+
+    def _read(self):
+        with self._open() as f:
+            return f.read()
+
+    # the content of a file of an archive that was materialized is held with
+    # the lazy values, so it's bounded by their size like the rest, and read
+    # again from the archive if it's dropped
+    def _hold_content(self, entry):
+        if entry.content is not None and "binary_content" not in self._lazy_evaluate_cache:
+            self._set_lazy_value("binary_content", entry.content)
+
+    def _register_lazy_attrs(self):
+        if self._in_archive and self._source is None and \
+                "binary_content" not in self._lazy_evaluate_cache:
+            return  # content is not available
+
         self._lazy_evaluate_attrs.update({
-            "binary_content": lambda: open(path, "rb").read(),
-            "text_content": lambda: open(path, "rb").read().decode('utf-8'),
+            "binary_content": lambda: self._read(),
+            "text_content": lambda: self._read().decode('utf-8'),
         })
 
+    def has_content(self):
+        return "binary_content" in self._lazy_evaluate_attrs and not hasattr(self, "directory")
+
+    # the content for the text/binary_content expectations, see content.py;
+    # it's only read into memory if it's there already, or if it has to be
+    # read from the archive
+    def content(self, attr: str):
+        text = attr == "text_content"
+        data = self._lazy_evaluate_cache.get(attr)
+        if data is None:
+            data = self._lazy_evaluate_cache.get("binary_content")
+        if data is None and self._in_archive:
+            data = self.binary_content
+        return Content(self.relpath, text, path=self.path, data=data)
+
+    # the content is not in memory and has to be read from the archive
+    def _unread(self):
+        return self._source is not None and \
+            "binary_content" not in self._lazy_evaluate_cache and self.has_content()
+
+    # lazy evaluators are closures that can't be pickled, drop them when
+    # sending the result across processes and register them again afterwards;
+    # the content is left out, the receiver has it already (see
+    # main.Explainer.result) or reads it again
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_lazy_evaluate_attrs"] = {}
+        state["_lazy_evaluate_cache"] = {k: v for k, v in self._lazy_evaluate_cache.items()
+                                         if k not in ("binary_content", "text_content")}
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._register_lazy_attrs()
+        for name, value in self._lazy_evaluate_cache.items():
+            lazy_values.add(self, name, value)
+
+    def _set_lazy_value(self, name, value):
+        self._lazy_evaluate_cache[name] = value
+        lazy_values.add(self, name, value)
+
     def __getattr__(self, name):
-        if name in self._lazy_evaluate_cache:
-            return self._lazy_evaluate_cache[name]
+        if name.startswith("_lazy_evaluate_"):
+            raise AttributeError(name)
+
+        # falsy values (empty lists, empty content) are cached as well
+        ret = self._lazy_evaluate_cache.get(name, _NOT_EVALUATED)
+        if ret is not _NOT_EVALUATED:
+            lazy_values.touch(self, name)
+            return ret
 
-        ret = None
         if name in self._lazy_evaluate_attrs:
             ret = self._lazy_evaluate_attrs[name]()
-
-        if ret:
-            self._lazy_evaluate_cache[name] = ret
+            self._set_lazy_value(name, ret)
             return ret
 
         return self.__getattribute__(name)
@@ -109,9 +304,35 @@ class FileInfo():
         return lines
 
 
+# reads the content of the files of archives that is not in memory yet, in
+# one pass over each artifact instead of one per file
+def read_contents(infos):
+    sources = collections.defaultdict(dict)
+    for f in infos:
+        if f._unread():
+            sources[f._source][f.relpath[1:]] = f
+    for source, files in sources.items():
+        for name, data in source.read(files).items():
+            files[name]._set_lazy_value("binary_content", data)
+
+
+class ExplainResults(list):
+    # explained files, plus the symlinks to ELF files that are left out of
+    # the manifest but are needed to resolve shared libraries
+    def __init__(self, infos=(), symlinks=None):
+        super().__init__(infos)
+        self.symlinks = symlinks if symlinks is not None else {}
+
+
 class ElfFileInfo(FileInfo):
-    def __init__(self, path, relpath):
-        super().__init__(path, relpath)
+    # attributes stored in the analysis cache
+    _cached_facts = ("arch", "needed_libraries", "rpath", "runpath")
+    _symbol_attrs = ("exported_symbols", "imported_symbols", "functions")
+
+    # digest is the sha256 of the content if it's known already; facts are
+    # the analysis results of a file with the same content, see dedup.py
+    def __init__(self, path, relpath, entry=None, digest=None, facts=None):
+        super().__init__(path, relpath, entry)
 
         self.arch = None
         self.needed_libraries = []
@@ -119,18 +340,80 @@ class ElfFileInfo(FileInfo):
         self.runpath = None
         self.get_exported_symbols = None
         self.get_imported_symbols = None
+        self.get_functions = None
         self.version_requirement = {}
+        self._cache_key = None
+
+        if self._in_archive:
+            if "binary_content" not in self._lazy_evaluate_cache:
+                return  # content is not materialized
+        elif not os.path.isfile(path):
+            return
 
-        if not os.path.isfile(path):
+        if facts is not None:
+            self._load_facts(facts)
+            self._register_lazy_attrs()
             return
 
-        with open(path, "rb") as f:
-            if f.read(4) != b"\x7fELF":
+        # the file is mapped once for the magic, the digest and all the
+        # readers of the analysis
+        with self._mapped() as buf:
+            if buf[:4] != b"\x7fELF":
                 return
 
-        binary = lief.parse(path)
-        if not binary:  # not an ELF file, malformed, etc
-            return
+            cache_key = None
+            if analysis_cache:
+                if digest is None:
+                    digest = buffer_digest(buf)
+                cache_key = analysis_cache.key(digest, type(self).__name__)
+                facts = analysis_cache.get(cache_key)
+                if facts is not None:
+                    self._cache_key = cache_key
+                    self._load_facts(facts)
+                    self._register_lazy_attrs()
+                    return
+
+            if not self._analyze():  # not an ELF file, malformed, etc
+                return
+        self._register_lazy_attrs()
+
+        if cache_key:
+            self._cache_key = cache_key
+            analysis_cache.set(cache_key, self._dump_facts())
+
+    def _analyze(self):
+        # the symbol tables are not needed for most files, read the dynamic
+        # section only and leave the full parse to when symbols are accessed
+        with self._open() as f:
+            dynamic = read_dynamic_info(f)
+
+        if dynamic:
+            try:
+                # lief._lief.ELF.ARCH.X86_64
+                self.arch = str(lief.ELF.ARCH.from_value(
+                    dynamic.machine)).split(".")[-1]
+            except RuntimeError:  # unknown to lief
+                dynamic = None
+
+        if not dynamic:
+            return self._analyze_binary()
+
+        self.needed_libraries = dynamic.needed_libraries
+        self.rpath = dynamic.rpath
+        self.runpath = dynamic.runpath
+        for lib, versions in dynamic.version_requirement.items():
+            self.version_requirement[lib] = sorted(
+                [LooseVersion(v) for v in versions])
+
+        return True
+
+    def _analyze_binary(self):
+        binary = self._parse()
+        if not binary:
+            return False
+
+        # the binary is parsed anyway, don't parse it again for the symbols
+        self._extract_symbols(binary)
 
         # lief._lief.ELF.ARCH.X86_64
         self.arch = str(binary.header.machine_type).split(".")[-1]
@@ -143,25 +426,97 @@ class ElfFileInfo(FileInfo):
             elif d.tag == lief._lief.ELF.DynamicEntry.TAG.RUNPATH:
                 self.runpath = d.runpath
 
-        # create closures and lazily evaluated
-        self.get_exported_symbols = lambda: sorted(
-            [d.name for d in binary.exported_symbols])
-        self.get_imported_symbols = lambda: sorted(
-            [d.name for d in binary.imported_symbols])
-        self.get_functions = lambda: sorted(
-            [d.name for d in binary.functions])
-
         for f in binary.symbols_version_requirement:
             self.version_requirement[f.name] = [LooseVersion(
                 a.name) for a in f.get_auxiliary_symbols()]
             self.version_requirement[f.name].sort()
 
+        return True
+
+    def _dump_facts(self, symbols=None):
+        facts = {k: getattr(self, k)
+                 for k in self._cached_facts if hasattr(self, k)}
+        facts["version_requirement"] = {
+            k: [str(v) for v in vs] for k, vs in self.version_requirement.items()}
+        # symbols are stored once they are evaluated, see _evaluate_symbols
+        if symbols is None:
+            symbols = {k: self._lazy_evaluate_cache[k]
+                       for k in self._symbol_attrs if k in self._lazy_evaluate_cache}
+        facts.update(symbols)
+        return facts
+
+    def _load_facts(self, facts):
+        for k, v in facts.items():
+            if k == "version_requirement":
+                self.version_requirement = {
+                    lib: [LooseVersion(a) for a in vs] for lib, vs in v.items()}
+            elif k in self._symbol_attrs:
+                # shared as they are immutable, see dedup.py
+                self._set_lazy_value(k, v if isinstance(v, SymbolList) else SymbolList(v))
+            else:
+                setattr(self, k, v)
+
+    def _register_lazy_attrs(self):
+        super()._register_lazy_attrs()
+
+        # the parsed binary is dropped when pickled, only ELF files that were
+        # parsed successfully have symbols to evaluate
+        if not getattr(self, "arch", None):
+            return
+
+        # create closures and lazily evaluated
+        self.get_exported_symbols = lambda: self.exported_symbols
+        self.get_imported_symbols = lambda: self.imported_symbols
+        self.get_functions = lambda: self.functions
+
         self._lazy_evaluate_attrs.update({
-            "exported_symbols": self.get_exported_symbols,
-            "imported_symbols": self.get_imported_symbols,
-            "functions": self.get_functions,
+            "exported_symbols": lambda: self._evaluate_symbols("exported_symbols"),
+            "imported_symbols": lambda: self._evaluate_symbols("imported_symbols"),
+            "functions": lambda: self._evaluate_symbols("functions"),
+            "dwarf_types": lambda: self._dwarf_names("types"),
+            "dwarf_functions": lambda: self._dwarf_names("functions"),
         })
 
+    def _extract_symbols(self, binary):
+        symbols = {k: SymbolList([d.name for d in getattr(binary, k)])
+                   for k in self._symbol_attrs}
+        for k, names in symbols.items():
+            self._set_lazy_value(k, names)
+        return symbols
+
+    def _evaluate_symbols(self, kind):
+        # this is where the full parse happens for most files; all the symbol
+        # lists are extracted at once so the lief object is released right
+        # away instead of being kept around for the next kind
+        binary = self._parse()
+        if not binary:
+            return []
+        symbols = self._extract_symbols(binary)
+        del binary
+
+        if self._cache_key and analysis_cache:
+            # update the cached entry so the next run doesn't need lief
+            analysis_cache.set(self._cache_key, self._dump_facts(symbols))
+
+        return symbols[kind]
+
+    def _dwarf_names(self, kind):
+        with self._open() as f:
+            index = DwarfIndex(ELFFile(f))
+            return SymbolList(index.types() if kind == "types" else index.functions())
+
+    def _parse(self):
+        if self._in_archive:
+            with self._mapped() as buf:
+                return lief.parse(buf)
+        return lief.parse(self.path)
+
+    def __getstate__(self):
+        state = super().__getstate__()
+        for k in ("get_exported_symbols", "get_imported_symbols", "get_functions"):
+            state[k] = None
+        return state
+
     def explain(self, opts: ExplainOpts):
         pline = super().explain(opts)
 
@@ -189,52 +544,72 @@ class ElfFileInfo(FileInfo):
         return pline + lines
 
 
+# build strings of nginx, as NUL terminated runs of printable characters
+# like the strings of lief's Binary.strings
+_NGINX_CONFIGURE_RE = re.compile(rb"(?<![\x20-\x7e]) *--prefix=/[\x20-\x7e]*(?=\0)")
+_NGINX_OPENSSL_RE = re.compile(rb"(?<![\x20-\x7e])built with ([\x20-\x7e]+) \(running with[\x20-\x7e]*(?=\0)")
+
+
 class NginxInfo(ElfFileInfo):
-    def __init__(self, path, relpath):
-        super().__init__(path, relpath)
+    _cached_facts = ElfFileInfo._cached_facts + (
+        "nginx_modules", "nginx_compiled_openssl", "nginx_compile_flags",
+        "has_dwarf_info", "has_ngx_http_request_t_DW")
+
+    def _analyze(self):
+        if not super()._analyze():
+            return False
 
         # nginx must be an ELF file
         if not self.needed_libraries:
-            return
+            return True
 
         self.nginx_modules = []
         self.nginx_compiled_openssl = None
         self.nginx_compile_flags = None
 
-        binary = lief.parse(path)
-
-        for s in binary.strings:
-            if re.match(r"\s*--prefix=/", s):
-                self.nginx_compile_flags = s
-                for m in re.findall("add(?:-dynamic)?-module=(.*?) ", s):
-                    if m.startswith("../"):  # skip bundled modules
-                        continue
-                    pdir = os.path.basename(os.path.dirname(m))
-                    mname = os.path.basename(m)
-                    if pdir in ("external", "distribution"):
-                        self.nginx_modules.append(mname)
-                    else:
-                        self.nginx_modules.append(os.path.join(pdir, mname))
-                self.nginx_modules = sorted(self.nginx_modules)
-            elif m := re.match(r"^built with (.+) \(running with", s):
-                self.nginx_compiled_openssl = m.group(1).strip()
-
-        # Fetch DWARF infos
-        with open(path, "rb") as f:
+        # the build strings and the DWARF infos are read through the same
+        # ELFFile, the binary isn't parsed by lief here
+        with self._open() as f:
             elffile = ELFFile(f)
+            self._scan_build_strings(elffile)
+
             self.has_dwarf_info = elffile.has_dwarf_info()
-            self.has_ngx_http_request_t_DW = False
-            dwarf_info = elffile.get_dwarf_info()
-            for cu in dwarf_info.iter_CUs():
-                dies = [die for die in cu.iter_DIEs()]
-                # Too many DIEs in the binary, we just check those in `ngx_http_request`
-                if "ngx_http_request" in dies[0].attributes['DW_AT_name'].value.decode('utf-8'):
-                    for die in dies:
-                        value = die.attributes.get('DW_AT_name') and die.attributes.get(
-                            'DW_AT_name').value.decode('utf-8')
-                        if value and value == "ngx_http_request_t":
-                            self.has_ngx_http_request_t_DW = True
-                            return
+            # Too many DIEs in the binary, we just check those in `ngx_http_request`
+            self.has_ngx_http_request_t_DW = DwarfIndex(elffile).has_type(
+                "ngx_http_request_t", cu_name="ngx_http_request")
+
+        return True
+
+    def _scan_build_strings(self, elffile):
+        # the strings of lief's Binary.strings are in .rodata too, only the
+        # two that are needed are searched for there
+        rodata = elffile.get_section_by_name(".rodata")
+        if not rodata or rodata["sh_type"] == "SHT_NOBITS":
+            return
+
+        # searched in place in the map instead of a copy of the section
+        with self._mapped() as buf, memoryview(buf) as view:
+            offset = rodata["sh_offset"]
+            with view[offset:offset + rodata["sh_size"]] as data:
+                self._search_build_strings(data)
+
+    def _search_build_strings(self, data):
+        for match in _NGINX_CONFIGURE_RE.finditer(data):
+            s = match.group(0).decode("ascii")
+            self.nginx_compile_flags = s
+            for m in re.findall("add(?:-dynamic)?-module=(.*?) ", s):
+                if m.startswith("../"):  # skip bundled modules
+                    continue
+                pdir = os.path.basename(os.path.dirname(m))
+                mname = os.path.basename(m)
+                if pdir in ("external", "distribution"):
+                    self.nginx_modules.append(mname)
+                else:
+                    self.nginx_modules.append(os.path.join(pdir, mname))
+            self.nginx_modules = sorted(self.nginx_modules)
+
+        for match in _NGINX_OPENSSL_RE.finditer(data):
+            self.nginx_compiled_openssl = match.group(1).decode("ascii").strip()
 
     def explain(self, opts: ExplainOpts):
         pline = super().explain(opts)
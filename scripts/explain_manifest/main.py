@@ -2,21 +2,37 @@
 
 import os
 import sys
-import glob
+import stat
 import time
+import glob
+import json
 import atexit
 import difflib
-import pathlib
 import argparse
 import tempfile
-from io import StringIO
+import threading
+import queue
+import itertools
+import collections
+import concurrent.futures
 from typing import List
 from pathlib import Path
 
 import config
 
-from explain import ExplainOpts, FileInfo, ElfFileInfo, NginxInfo
-from expect import ExpectChain, glob_match_ignore_slash
+from cache import AnalysisCache, worker_context
+from manifest import ManifestDiff, dump_record, dump_records, format_manifest, format_record
+from archive import ArchiveContent, ArchiveEntry, is_archive, iter_archive, read_image
+import archive
+from walk import scan_tree
+from watch import Watcher, watch
+from profiling import Profiler
+from dedup import ContentIndex
+import profiling
+import dedup
+from explain import ExplainOpts, ExplainResults, FileInfo, ElfFileInfo, NginxInfo
+import explain
+from expect import ExpectChain, compile_globs, glob_match_ignore_slash, manifest_diff
 
 
 def parse_args():
@@ -24,7 +40,7 @@ def parse_args():
     parser.add_argument(
         "--path", "-p", help="Path to the directory, binary package or docker image tag to compare")
     parser.add_argument(
-        "--image", help="Docker image tag to compare")
+        "--image", help="Docker image tag, `docker save` tarball or OCI image layout to compare")
     parser.add_argument(
         "--output", "-o", help="Path to output manifest, use - to write to stdout")
     parser.add_argument(
@@ -49,6 +65,41 @@ def parse_args():
     parser.add_argument("--version_requirement",
                         help="Display exported symbols",
                         action="store_true")
+    parser.add_argument("--platform", default=os.environ.get("DOCKER_DEFAULT_PLATFORM"),
+                        help="Platform of the image to explain (e.g. linux/arm64) when it has several, " +
+                        "defaults to $DOCKER_DEFAULT_PLATFORM or the one of the machine")
+    parser.add_argument("--jobs", "-j", type=int, default=1,
+                        help="Number of processes used to analyze files in parallel")
+    parser.add_argument("--cache_dir",
+                        help="Path to the directory to cache ELF analysis results across runs")
+    parser.add_argument("--cache_max_size", type=int, default=1024,
+                        help="Maximum size of the analysis cache in MiB")
+    parser.add_argument("--lazy_cache_max_size", type=int, default=512,
+                        help="Maximum memory in MiB held by lazily evaluated attributes " +
+                        "(file content, symbols, etc.), least recently used ones are evaluated again")
+    parser.add_argument("--batch", help="Path to a JSON file mapping artifacts to the suites " +
+                        "to test them with; --output is then a directory to write the manifests to, " +
+                        "named after the suite (and the artifact when a suite tests several)")
+    parser.add_argument("--output_format", choices=("text", "jsonl"), default="text",
+                        help="Format of the output manifest, jsonl writes one JSON object per file")
+    parser.add_argument("--diff_format", choices=("text", "json"), default="text",
+                        help="Format of the differences printed when the manifest is not up-to-date")
+    parser.add_argument("--report",
+                        help="Path to write the pass/fail report of a batch run as JSON")
+    parser.add_argument("--dedup", action="store_true",
+                        help="Analyze ELF files with the same content once, always on with --batch")
+    parser.add_argument("--watch", action="store_true",
+                        help="Keep watching the directory given with --path, explain again the files " +
+                        "changed and run the expectations of --suite matching them")
+    parser.add_argument("--watch_interval", type=float, default=0.25,
+                        help="Seconds between two scans of the watched directory")
+    parser.add_argument("--stream", action="store_true",
+                        help="Write the manifest while the files are explained instead of at once, " +
+                        "files are only kept in memory for --suite")
+    parser.add_argument("--profile",
+                        help="Path to write the time and memory spent in each phase as JSON")
+    parser.add_argument("--profile_files", type=int, default=20,
+                        help="Number of the slowest files to analyze listed in the profile")
 
     return parser.parse_args()
 
@@ -60,130 +111,698 @@ def read_glob(path: str):
     with open(path, "r") as f:
         return f.read().splitlines()
 
-def gather_files(path: str, image: str):
-    if image:
-        t = tempfile.TemporaryDirectory()
-        atexit.register(t.cleanup)
-
-        code = os.system("docker pull {img} && docker create --name={name} {img} && docker export {name} | tar xf - -C {tmp} && docker rm -f {name}".format(
-            img=image, 
-            name="explain_manifest_%d" % time.time(), 
-            tmp=t.name
-        ))
-
-        if code != 0:
-            raise Exception("Failed to extract image %s" % image)
-        return t.name
-    
-    ext = os.path.splitext(path)[1]
-    if ext in (".deb", ".rpm") or path.endswith(".apk.tar.gz"):
-        t = tempfile.TemporaryDirectory()
-        atexit.register(t.cleanup)
-
-        if ext == ".deb":
-            code = os.system(
-                "ar p %s data.tar.gz | tar -C %s -xz" % (path, t.name))
-        elif ext == ".rpm":
-            # rpm2cpio is needed
-            # rpm2archive ships with rpm2cpio on debians
-            # https://github.com/rpm-software-management/rpm/commit/37b963fa51d6ad31086a6e345ce6701afda5afff
-            # rpm2archive has changed the behaviour to extract to stdout if stdout is not tty
-            code = os.system(
-                """
-                    rpm2archive %s | tar -C %s -xz
-                """ % (path, t.name))
-        elif ext == ".gz":
-            code = os.system("tar -C %s -xf %s" % (t.name, path))
-
-        if code != 0:
-            raise Exception("Failed to extract %s" % path)
-
-        return t.name
-    elif not Path(path).is_dir():
-        raise Exception("Don't know how to process \"%s\"" % path)
-
-    return path
-
-
-def walk_files(path: str, globs: List[str]):
-    results = []
-    # use pathlib instead of glob.glob to avoid recurse into symlink dir
-    for file in sorted(pathlib.Path(path).rglob("*")):
-        full_path = str(file)
-        file = str(file.relative_to(path))
-
-        if globs and not glob_match_ignore_slash(file, globs):
-            continue
+def save_image(image: str):
+    t = tempfile.TemporaryDirectory()
+    atexit.register(t.cleanup)
 
-        if not file.startswith("/") and not file.startswith("./"):
-            file = '/' + file  # prettifier
+    tarball = os.path.join(t.name, "image.tar")
+    platform = "--platform %s " % archive.image_platform if archive.image_platform else ""
+    code = os.system("docker pull {platform}{img} && docker save {platform}-o {tar} {img}".format(
+        img=image,
+        tar=tarball,
+        platform=platform,
+    ))
 
-        if file.endswith("sbin/nginx"):
-            f = NginxInfo(full_path, file)
-        elif os.path.splitext(file)[1] == ".so" or os.path.basename(os.path.dirname(file)) in ("bin", "lib", "lib64", "sbin"):
-            p = Path(full_path)
-            if p.is_symlink():
-                continue
-            f = ElfFileInfo(full_path, file)
+    if code != 0:
+        raise Exception("Failed to save image %s" % image)
+    return tarball
+
+
+def likely_elf(relpath: str):
+    return os.path.splitext(relpath)[1] == ".so" or \
+        os.path.basename(os.path.dirname(relpath)) in ("bin", "lib", "lib64", "sbin")
+
+
+def explain_class(full_path: str, relpath: str, entry: ArchiveEntry = None):
+    if relpath.endswith("sbin/nginx"):
+        return NginxInfo
+    elif likely_elf(relpath):
+        if entry.is_symlink() if entry else Path(full_path).is_symlink():
+            return None
+        return ElfFileInfo
+
+    return FileInfo
+
+
+def explain_file(full_path: str, relpath: str, entry: ArchiveEntry = None, digest: str = None):
+    # the time is kept with the result for the profile, see profiling.py
+    wall = time.perf_counter()
+    cpu = time.thread_time()
+    cls = explain_class(full_path, relpath, entry)
+    if cls is None:
+        return None
+    elif cls is FileInfo:
+        f = FileInfo(full_path, relpath, entry)
+    else:
+        f = cls(full_path, relpath, entry, digest=digest)
+    f._analysis_time = (time.perf_counter() - wall, time.thread_time() - cpu)
+    return f
+
+
+def _init_worker(cache, lazy_values_max_size):
+    explain.set_analysis_cache(cache)
+    explain.set_lazy_values_max_size(lazy_values_max_size)
+
+
+# the workers are started from a fork server, not forked from this process:
+# they are started lazily, once the threads reading the artifacts are already
+# running and may hold locks that a forked child would never see released;
+# the state they need is passed to _init_worker as they don't inherit it
+def analysis_executor(jobs: int):
+    return concurrent.futures.ProcessPoolExecutor(
+        max_workers=jobs,
+        mp_context=worker_context,
+        initializer=_init_worker,
+        initargs=(explain.analysis_cache, explain.lazy_values.max_size))
+
+
+class _Task():
+    __slots__ = ("full_path", "relpath", "entry", "cls", "key", "future", "info", "shared")
+
+    def __init__(self, full_path, relpath, entry, cls, key):
+        self.full_path = full_path
+        self.relpath = relpath
+        self.entry = entry
+        self.cls = cls
+        # (kind, digest) when files are deduplicated, see dedup.py
+        self.key = key
+        self.future = None
+        self.info = None
+        self.shared = False
+
+
+# explains files as soon as they are submitted, so the analysis of the ELF
+# files of an artifact overlaps with reading the rest of it: they are sent to
+# the executor if any, the other files are explained right away; files with
+# the same content as one submitted before share its analysis
+class Explainer():
+    def __init__(self, jobs: int = 1, executor: concurrent.futures.Executor = None):
+        self._own_executor = None
+        if not executor and jobs > 1:
+            executor = self._own_executor = analysis_executor(jobs)
+        self._executor = executor
+        self._index = dedup.content_index
+        # relpath -> _Task, a file can be submitted again with another entry
+        # (e.g. replaced by an upper layer of an image)
+        self._tasks = {}
+
+    def submit(self, full_path: str, relpath: str, entry: ArchiveEntry = None):
+        task = self._tasks.get(relpath)
+        if task and task.entry is entry:
+            return task
+
+        cls = explain_class(full_path, relpath, entry)
+        is_elf = cls in (ElfFileInfo, NginxInfo) and (entry is None or entry.is_file())
+        key = None
+        if self._index and is_elf:
+            digest = self._index.digest(full_path, entry)
+            if digest:
+                key = (cls.__name__, digest)
+
+        task = self._tasks[relpath] = _Task(full_path, relpath, entry, cls, key)
+        # the content index is shared by the artifacts of a batch, the first
+        # file of a content may be in another one
+        if key and not self._index.claim(key):
+            task.shared = True
+            return task
+
+        if is_elf and self._executor:
+            task.future = self._executor.submit(explain_file, full_path, relpath, entry, key and key[1])
+            if key:
+                self._index.add_when_done(key, task.future)
         else:
-            f = FileInfo(full_path, file)
+            try:
+                task.info = explain_file(full_path, relpath, entry, key and key[1])
+            finally:
+                if key:  # None if it failed, not to leave the others waiting
+                    self._index.add(key, task.info)
+        return task
+
+    def result(self, task: _Task):
+        if task.future:
+            task.info = task.future.result()
+            task.future = None
+            if task.info is not None and task.entry is not None:
+                # the content is not sent back by the workers
+                task.info._hold_content(task.entry)
+        elif task.shared:
+            # waits for the analysis of the first file if it's still running
+            task.info = self._index.explain(task.key, task.cls, task.full_path, task.relpath, task.entry) or \
+                explain_file(task.full_path, task.relpath, task.entry, task.key[1])
+            task.shared = False
+        return task.info
+
+    def close(self):
+        if self._own_executor:
+            self._own_executor.shutdown()
+
+
+# number of files submitted ahead of the one being explained when streaming,
+# keeps the executor busy without explaining the whole artifact up front
+STREAM_AHEAD = 256
+
+
+# yields the explained files of (full_path, relpath, entry) in order, the
+# symlinks to ELF files are left out and added to symlinks instead; with
+# release (streaming), files are submitted STREAM_AHEAD at a time and each
+# explained file and the content of its entry are let go once the consumer is
+# done with it, so they are not all kept in memory
+def iter_explained(files, explainer: Explainer, symlinks: dict = None, release: bool = False):
+    if symlinks is None:
+        symlinks = {}
+    files = iter(files)
+    pending = collections.deque()
+
+    def submit(n=None):
+        for args in itertools.islice(files, n):
+            pending.append((args[1], args[2], explainer.submit(*args)))
+
+    phase = profiling.start("analyze")
+    try:
+        # everything (or the first files when streaming) is submitted first so
+        # the executor has work queued
+        submit(STREAM_AHEAD if release else None)
+        while pending:
+            relpath, entry, task = pending.popleft()
+            if release:
+                submit(1)
+            f = explainer.result(task)
+            if release:
+                task.info = None
+            if f is None:
+                if entry is not None and entry.is_symlink():
+                    symlinks[relpath] = entry.link
+                continue
+
+            config.transform(f)
+            if profiling.profiler:
+                profiling.profiler.record_files((f,))
+            yield f
 
-        config.transform(f)
-        results.append(f)
+            if release and entry is not None and not entry.on_disk:
+                entry.content = None
+    finally:
+        profiling.stop(phase)
 
+
+# the files yielded by an iter_* generator, as ExplainResults
+def collect(iterate, *args, **kwargs):
+    results = ExplainResults()
+    results.extend(iterate(*args, symlinks=results.symlinks, **kwargs))
     return results
 
 
-def write_manifest(title: str, results: List[FileInfo], globs: List[str], opts: ExplainOpts):
-    f = StringIO()
+def explain_files(full_paths: List[str], relpaths: List[str], entries: List[ArchiveEntry], jobs: int = 1,
+                  executor: concurrent.futures.Executor = None, explainer: Explainer = None):
+    own_explainer = None
+    if not explainer:
+        explainer = own_explainer = Explainer(jobs, executor)
+
+    results = collect(iter_explained, zip(full_paths, relpaths, entries), explainer)
+
+    if own_explainer:
+        own_explainer.close()
+    return results
 
-    for result in results:
-        if not glob_match_ignore_slash(result.relpath, globs):
+
+# size of the queue between the thread reading an artifact and the one
+# analyzing it, bounds the content read ahead of the analysis
+READ_AHEAD_QUEUE_SIZE = 256
+
+
+def read_ahead(read, consume, want=lambda entry: True):
+    # runs read(emit) in a thread and consume(entry) for each entry it emits
+    # while it's still reading (decompression releases the GIL), returns
+    # what read returns; only the entries passing want(entry) are handed
+    # over to keep the threads from contending for the others
+    q = queue.Queue(maxsize=READ_AHEAD_QUEUE_SIZE)
+    stopped = threading.Event()
+    done = object()
+    result = {}
+
+    def emit(entry):
+        if stopped.is_set():
+            raise Exception("stopped reading")
+        if want(entry):
+            q.put(entry)
+
+    def reader():
+        try:
+            result["value"] = read(emit)
+        except BaseException as e:
+            result["error"] = e
+        finally:
+            q.put(done)
+
+    t = threading.Thread(target=reader, daemon=True)
+    t.start()
+    try:
+        while (entry := q.get()) is not done:
+            consume(entry)
+    finally:
+        # unblocks the reader if consume raised
+        stopped.set()
+        while t.is_alive():
+            try:
+                q.get(timeout=0.05)
+            except queue.Empty:
+                pass
+        t.join()
+
+    if "error" in result:
+        raise result["error"]
+    return result["value"]
+
+
+def iter_files(path: str, globs: List[str], jobs: int = 1, symlinks: dict = None,
+               release: bool = False):
+    matcher = compile_globs(globs) if globs else None
+    explainer = Explainer(jobs)
+
+    # files are submitted while the tree is scanned, the scan is done first
+    # unless streaming
+    def scan():
+        # symlinked directories are not recursed into, like pathlib's rglob
+        entries = scan_tree(path)
+        # only the scan is timed, not the files explained between two entries
+        timing = [0.0, 0.0]
+        try:
+            while True:
+                wall = time.perf_counter()
+                cpu = time.thread_time()
+                entry = next(entries, None)
+                while entry is not None and matcher and not matcher(entry.name):
+                    entry = next(entries, None)
+                timing[0] += time.perf_counter() - wall
+                timing[1] += time.thread_time() - cpu
+                if entry is None:
+                    return
+                # prettifier
+                yield os.path.join(path, entry.name), "/" + entry.name, entry
+        finally:
+            if profiling.profiler:
+                profiling.profiler.add("walk", *timing)
+
+    try:
+        yield from iter_explained(scan(), explainer, symlinks, release)
+    finally:
+        explainer.close()
+
+
+def walk_files(path: str, globs: List[str], jobs: int = 1):
+    return collect(iter_files, path, globs, jobs)
+
+
+def sorted_entries(source: str, entries: dict, globs: List[str]):
+    # parent directories missing from the archive would have been created
+    # when extracting it
+    for name in list(entries):
+        parent = os.path.dirname(name)
+        while parent and parent not in entries:
+            entries[parent] = ArchiveEntry(
+                parent, stat.S_IFDIR | 0o755, os.getuid(), os.getgid())
+            parent = os.path.dirname(parent)
+
+    files = []
+    # same order as sorting the pathlib.Path of the extracted files
+    for name in sorted(entries, key=lambda n: n.split("/")):
+        if globs and not glob_match_ignore_slash(name, globs):
+            del entries[name]
             continue
 
-        entries = result.explain(opts)
-        ident = 2
-        first = True
-        for k, v in entries:
-            if isinstance(v, list):
-                v = ("\n" + " " * ident + "- ").join([""] + v)
-            else:
-                v = " %s" % v
-            if first:
-                f.write("-" + (" " * (ident-1)))
-                first = False
-            else:
-                f.write(" " * ident)
-            f.write("%-10s:%s\n" % (k, v))
-        f.write("\n")
+        files.append((os.path.join(source, name), "/" + name, entries[name]))
+    return files
+
+
+def _read_and_explain(source: str, read, globs: List[str], jobs: int,
+                      executor: concurrent.futures.Executor, symlinks: dict = None,
+                      release: bool = False):
+    # ELF files with their content read are analyzed while the rest of the
+    # artifact is read; the entries that are replaced or removed afterwards
+    # are analyzed for nothing
+    explainer = Explainer(jobs, executor)
+
+    def want(entry):
+        return entry.content is not None and likely_elf("/" + entry.name)
+
+    def consume(entry):
+        explainer.submit(os.path.join(source, entry.name), "/" + entry.name, entry)
+
+    try:
+        with profiling.phase("extract"):
+            entries = read_ahead(read, consume, want)
+        files = sorted_entries(source, entries, globs)
+        del entries
+        yield from iter_explained(files, explainer, symlinks, release)
+    finally:
+        explainer.close()
+
+
+def iter_archive_files(path: str, globs: List[str], jobs: int = 1,
+                       executor: concurrent.futures.Executor = None, symlinks: dict = None,
+                       release: bool = False):
+    def want_content(name):
+        # only ELF files are analyzed by content
+        if globs and not glob_match_ignore_slash(name, globs):
+            return False
+        return likely_elf("/" + name)
+
+    # the content of the other files is read again if expectations need it
+    source = ArchiveContent(path)
+
+    def read(emit):
+        entries = {}
+        for entry in iter_archive(path, want_content):
+            if entry.is_file():
+                entry.source = source
+            entries[entry.name] = entry
+            emit(entry)
+        return entries
+
+    return _read_and_explain(path, read, globs, jobs, executor, symlinks, release)
+
+
+def walk_archive(path: str, globs: List[str], jobs: int = 1,
+                 executor: concurrent.futures.Executor = None):
+    return collect(iter_archive_files, path, globs, jobs, executor)
+
+
+def iter_image_files(path: str, globs: List[str], jobs: int = 1,
+                     executor: concurrent.futures.Executor = None, symlinks: dict = None,
+                     release: bool = False):
+    def keep(name):
+        return not globs or glob_match_ignore_slash(name, globs)
+
+    # only ELF files are analyzed by content, the content of the other files
+    # is read again if expectations need it, like for packages
+    def want_content(name):
+        return keep(name) and likely_elf("/" + name)
+
+    source = ArchiveContent(path, image=True)
+
+    def read(emit):
+        def on_entry(entry):
+            if entry.is_file():
+                entry.source = source
+            emit(entry)
 
-    f.flush()
+        return read_image(path, keep=keep, want_content=want_content, on_entry=on_entry)
 
-    return f.getvalue().encode("utf-8")
+    return _read_and_explain(path, read, globs, jobs, executor, symlinks, release)
+
+
+def walk_image(path: str, globs: List[str], jobs: int = 1,
+               executor: concurrent.futures.Executor = None):
+    return collect(iter_image_files, path, globs, jobs, executor)
+
+
+def iter_artifact(path: str, image: bool, globs: List[str], jobs: int = 1,
+                  executor: concurrent.futures.Executor = None, symlinks: dict = None,
+                  release: bool = False):
+    if image:
+        # a `docker save` tarball or OCI layout can be used without docker
+        if not os.path.exists(path):
+            path = save_image(path)
+        # filter by filelist only when explaining an image to reduce time
+        return iter_image_files(path, globs, jobs, executor, symlinks, release)
+    elif is_archive(path):
+        # packages are streamed without being extracted to disk
+        return iter_archive_files(path, None, jobs, executor, symlinks, release)
+
+    raise Exception("Don't know how to process \"%s\"" % path)
+
+
+def walk_artifact(path: str, image: bool, globs: List[str], jobs: int = 1,
+                  executor: concurrent.futures.Executor = None):
+    return collect(iter_artifact, path, image, globs, jobs, executor)
+
+
+def manifest_records(results: List[FileInfo], globs: List[str], opts: ExplainOpts):
+    matcher = compile_globs(globs)
+    with profiling.phase("manifest"):
+        return [dict(result.explain(opts)) for result in results if matcher(result.relpath)]
+
+
+def write_manifest(title: str, results: List[FileInfo], globs: List[str], opts: ExplainOpts):
+    records = manifest_records(results, globs, opts)
+    with profiling.phase("manifest"):
+        return format_manifest(records)
+
+
+# writes the records of the files yielded by an iter_* generator as they're
+# explained, to f (a binary file) if any and to diff if any, instead of
+# building the manifest in memory; diff is always given the text format
+def stream_manifest(files, globs: List[str], opts: ExplainOpts, f=None, output_format: str = "text",
+                    diff: ManifestDiff = None):
+    matcher = compile_globs(globs)
+    with profiling.phase("stream"):
+        for result in files:
+            if not matcher(result.relpath):
+                continue
+            record = dict(result.explain(opts))
+            text = format_record(record)
+            if diff is not None:
+                diff.add(text.decode("utf-8"))
+            if f is not None:
+                f.write(dump_record(record) if output_format == "jsonl" else text)
+
+
+def get_suite(name: str):
+    if name not in config.targets:
+        closest = difflib.get_close_matches(name, config.targets.keys(), 1)
+        maybe = ""
+        if closest:
+            maybe = ", maybe you meant %s" % closest[0]
+        raise Exception("Unknown suite %s%s" % (name, maybe))
+    return config.targets[name]
+
+
+class BatchItem():
+    def __init__(self, path: str, suites: List[str], image: bool = False, file_list: str = None):
+        self.path = path
+        self.suites = suites
+        self.image = image
+        self.file_list = file_list
+        # {suite: name of the manifest written to --output}, see read_batch
+        self.outputs = {}
+
+
+def read_batch(path: str, file_list: str = None):
+    # {"<artifact>": ["<suite>", ...]} or
+    # {"<artifact>": {"suites": [...], "image": true, "file_list": "..."}}
+    with open(path, "r") as f:
+        doc = json.load(f)
+
+    items = []
+    for artifact, v in doc.items():
+        if isinstance(v, (str, list)):
+            v = {"suites": v}
+        suites = v.get("suites", [])
+        if isinstance(suites, str):
+            suites = [suites]
+        for s in suites:
+            get_suite(s)  # fail early on typos
+        items.append(BatchItem(artifact, suites,
+                               image=v.get("image", not is_archive(artifact)),
+                               file_list=v.get("file_list", file_list)))
+
+    # the manifest of a suite is written to <suite>, or <suite>-<artifact>
+    # when the suite tests several artifacts not to overwrite each other
+    used = collections.Counter(s for item in items for s in set(item.suites))
+    written = {}
+    for item in items:
+        for s in item.suites:
+            name = s if used[s] == 1 else "%s-%s" % (s, os.path.basename(item.path.rstrip("/")))
+            if written.setdefault(name, item.path) != item.path:
+                raise Exception("Artifacts %s and %s would both write the manifest %s of suite %s" % (
+                    written[name], item.path, name, s))
+            item.outputs[s] = name
+    return items
+
+
+def run_batch(items: List[BatchItem], args):
+    opts = ExplainOpts.from_args(args)
+    # artifacts are read by a bounded thread pool, while the ELF analysis of
+    # all of them is shared by one process pool
+    executor = analysis_executor(args.jobs) if args.jobs > 1 else None
+    readers = concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(1, min(args.jobs, len(items))))
+    futures = [readers.submit(walk_artifact, item.path, item.image, read_glob(item.file_list),
+                              args.jobs, executor) for item in items]
+
+    if args.output:
+        os.makedirs(args.output, exist_ok=True)
+
+    report = []
+    # suites are run in the order of the batch file while the following
+    # artifacts are still being analyzed
+    for i, item in enumerate(items):
+        try:
+            infos = futures[i].result()
+        except Exception as e:
+            for name in item.suites:
+                report.append({"artifact": item.path, "suite": name, "passed": False,
+                               "failures": ["failed to explain artifact: %s" % e],
+                               "manifest_diff": []})
+            continue
+        finally:
+            futures[i] = None
+
+        records = manifest_records(infos, read_glob(item.file_list), opts)
+        with profiling.phase("manifest"):
+            manifest = format_manifest(records)
+        for name in item.suites:
+            # a suite failing to run fails alone, the others are still run
+            # and reported
+            try:
+                suite = get_suite(name)
+                E = ExpectChain(infos, exit_on_failure=False)
+                changes = E.compare_manifest(suite, manifest, args.diff_format)
+                E.run(suite)
+                failures = E.failures()
+            except Exception as e:
+                changes = []
+                failures = ["failed to run suite: %s" % e]
+            report.append({"artifact": item.path, "suite": name,
+                           "passed": not failures, "failures": failures,
+                           "manifest_diff": changes})
+
+            if args.output:
+                with profiling.phase("write"):
+                    output = os.path.join(args.output, item.outputs[name])
+                    if args.output_format == "jsonl":
+                        with open(output + ".jsonl", "wb") as f:
+                            f.write(dump_records(records))
+                    else:
+                        with open(output + ".txt", "wb") as f:
+                            f.write(manifest)
+
+    readers.shutdown()
+    if executor:
+        executor.shutdown()
+
+    return report
+
+
+def write_report(report: List[dict], f=sys.stdout):
+    f.write("\n[INFO] batch report:\n")
+    for r in report:
+        f.write("[%s] %s (%s)\n" % ("PASS" if r["passed"] else "FAIL", r["suite"], r["artifact"]))
+        for failure in r["failures"]:
+            f.write("    %s\n" % failure)
+    failed = len([r for r in report if not r["passed"]])
+    f.write("[INFO] %d/%d suite(s) passed\n" % (len(report) - failed, len(report)))
 
 
 if __name__ == "__main__":
     args = parse_args()
 
+    if args.profile:
+        profiling.set_profiler(Profiler(slowest_files=args.profile_files))
+
+    explain.set_lazy_values_max_size(args.lazy_cache_max_size * 1024 * 1024)
+
+    if args.platform:
+        archive.set_image_platform(args.platform)
+
+    if args.cache_dir:
+        explain.set_analysis_cache(AnalysisCache(
+            args.cache_dir, max_size=args.cache_max_size * 1024 * 1024))
+
+    if args.batch or args.dedup:
+        dedup.set_content_index(ContentIndex())
+
+    if args.batch:
+        report = run_batch(read_batch(args.batch, args.file_list), args)
+        if explain.analysis_cache:
+            explain.analysis_cache.prune()
+            explain.analysis_cache.report()
+        dedup.content_index.report()
+        write_report(report)
+        if args.report:
+            with open(args.report, "w") as f:
+                json.dump(report, f, indent=2)
+        if args.profile:
+            profiling.profiler.write(args.profile)
+        sys.exit(0 if all(r["passed"] for r in report) else 1)
+
+    if args.watch:
+        if not args.path or not Path(args.path).is_dir():
+            raise Exception("--watch only works with a directory given with --path")
+        # the worker processes are kept across the changes
+        executor = analysis_executor(args.jobs) if args.jobs > 1 else None
+        watcher = Watcher(args.path, read_glob(args.file_list), ExplainOpts.from_args(args),
+                          explain_files, args.jobs, executor)
+        watch(watcher, get_suite(args.suite) if args.suite else None, args.output,
+              args.watch_interval)
+        if executor:
+            executor.shutdown()
+        sys.exit(0)
+
     if not args.suite and not args.output:
         raise Exception("At least one of --suite or --output is required")
 
     if not args.path and not args.image:
         raise Exception("At least one of --path or --image is required")
 
-    if args.image and os.getuid() != 0:
-        raise Exception("Running as root is required to explain an image")
-
     if args.path and Path(args.path).is_dir():
         raise Exception(
             "suite mode only works with archive files (deb, rpm, apk.tar.gz, etc.")
 
-    directory = gather_files(args.path, args.image)
-
     globs = read_glob(args.file_list)
 
-    # filter by filelist only when explaining an image to reduce time
-    infos = walk_files(directory, globs=globs if args.image else None)
+    if args.stream:
+        suite = get_suite(args.suite) if args.suite else None
+        # the expectations need all the files, the manifest diff doesn't
+        infos = ExplainResults() if suite else None
+        files = iter_artifact(args.image or args.path, bool(args.image), globs, jobs=args.jobs,
+                              symlinks=infos.symlinks if suite else None, release=not suite)
+        if suite:
+            def keep(files):
+                for info in files:
+                    infos.append(info)
+                    yield info
+            files = keep(files)
+
+        if args.output == "-":
+            sys.stdout.flush()
+            f = sys.stdout.buffer
+        elif args.output:
+            f = open(args.output, "wb")
+        else:
+            f = None
+        diff = manifest_diff(suite) if suite else None
+        stream_manifest(files, globs, ExplainOpts.from_args(args), f, args.output_format, diff)
+        if args.output == "-":
+            f.flush()
+        elif f:
+            f.close()
+
+        if explain.analysis_cache:
+            explain.analysis_cache.prune()
+            explain.analysis_cache.report()
+        if dedup.content_index:
+            dedup.content_index.report()
+
+        if suite:
+            E = ExpectChain(infos)
+            E.report_manifest_diff(suite, diff, args.diff_format)
+            E.run(suite)
+
+        if args.profile:
+            profiling.profiler.write(args.profile)
+        sys.exit(0)
+
+    if args.image:
+        infos = walk_artifact(args.image, True, globs, jobs=args.jobs)
+    else:
+        infos = walk_artifact(args.path, False, globs, jobs=args.jobs)
+
+    if explain.analysis_cache:
+        explain.analysis_cache.prune()
+        explain.analysis_cache.report()
+    if dedup.content_index:
+        dedup.content_index.report()
 
     if args.image:
         title = "contents in image %s" % args.image
@@ -192,26 +811,29 @@ if __name__ == "__main__":
     else:
         title = "contents in directory %s" % args.path
 
-    manifest = write_manifest(title, infos, globs, ExplainOpts.from_args(args))
+    records = manifest_records(infos, globs, ExplainOpts.from_args(args))
+    with profiling.phase("manifest"):
+        manifest = format_manifest(records)
 
     if args.suite:
-        if args.suite not in config.targets:
-            closest = difflib.get_close_matches(
-                config.targets.keys(), args.suite, 1)
-            maybe = ""
-            if closest:
-                maybe = ", maybe you meant %s" % closest[0]
-            raise Exception("Unknown suite %s%s" % (args.suite, maybe))
+        suite = get_suite(args.suite)
         E = ExpectChain(infos)
-        E.compare_manifest(config.targets[args.suite], manifest)
-        E.run(config.targets[args.suite])
+        E.compare_manifest(suite, manifest, args.diff_format)
+        E.run(suite)
 
     if args.output:
-        if args.output == "-":
-            f = sys.stdout
-            manifest = manifest.decode("utf-8")
-        else:
-            f = open(args.output, "wb")
-        f.write(manifest)
-        if args.output != "-":
-            f.close()
+        with profiling.phase("write"):
+            if args.output_format == "jsonl":
+                manifest = dump_records(records)
+            if args.output == "-":
+                f = sys.stdout
+                manifest = manifest.decode("utf-8")
+            else:
+                f = open(args.output, "wb")
+            f.write(manifest)
+            if args.output != "-":
+                f.close()
+
+    # before failed expectations exit at exit, see ExpectChain._print_all_fails
+    if args.profile:
+        profiling.profiler.write(args.profile)
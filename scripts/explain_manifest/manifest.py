@@ -0,0 +1,173 @@
+import json
+from collections import Counter
+
+
+def _normalize(s: str):
+    # same as `diff -b`, changes in the amount of white space are ignored
+    return " ".join(s.split())
+
+
+# records are the dicts of the (attribute, value) pairs returned by
+# FileInfo.explain, in the same order
+def format_record(record):
+    lines = []
+    ident = 2
+    first = True
+    for k, v in record.items():
+        if isinstance(v, list):
+            v = ("\n" + " " * ident + "- ").join([""] + v)
+        else:
+            v = " %s" % v
+        if first:
+            lines.append("-" + (" " * (ident-1)))
+            first = False
+        else:
+            lines.append(" " * ident)
+        lines.append("%-10s:%s\n" % (k, v))
+    lines.append("\n")
+
+    return "".join(lines).encode("utf-8")
+
+
+def format_manifest(records):
+    return b"".join(map(format_record, records))
+
+
+# one JSON object per line and per file, values keep their types (e.g. Size
+# is a number, DWARF a boolean) so the text format can be derived from it
+def dump_record(record):
+    return (json.dumps(record, ensure_ascii=False, separators=(",", ":"), default=str) + "\n").encode("utf-8")
+
+
+def dump_records(records):
+    return b"".join(map(dump_record, records))
+
+
+def load_records(f):
+    return [json.loads(line) for line in f if line.strip()]
+
+
+# returns {path: record} of a manifest in either format, paths are kept in
+# the order of the manifest; values of the text format are all strings
+def load_manifest(path: str):
+    with open(path, "r") as f:
+        if path.endswith(".jsonl"):
+            return {r["Path"]: r for r in load_records(f)}
+        return parse_manifest(f.read())
+
+
+# parses a manifest written by main.write_manifest into
+# {path: {attribute: value}}, values are either a string or a list of strings;
+# blank lines are ignored like `diff -B`
+def parse_manifest(text: str):
+    records = {}
+    record = None
+    attr = None
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+
+        stripped = line.strip()
+        if line.startswith("-") or not stripped.startswith("- "):
+            if line.startswith("-"):
+                record = None
+                stripped = stripped[1:]
+            key, _, value = stripped.partition(":")
+            key = _normalize(key)
+            value = _normalize(value)
+            if record is None:
+                record = {}
+                records[value] = record
+            # a key without value is followed by the list items
+            record[key] = value if value else []
+            attr = key
+        elif record is not None and isinstance(record.get(attr), list):
+            record[attr].append(_normalize(stripped[2:]))
+
+    return records
+
+
+def _diff_values(attr: str, old, new):
+    if isinstance(old, list) and isinstance(new, list):
+        old_counts = Counter(old)
+        new_counts = Counter(new)
+        added = list((new_counts - old_counts).elements())
+        removed = list((old_counts - new_counts).elements())
+        change = {"attribute": attr, "added": added, "removed": removed}
+        if not added and not removed:
+            change["reordered"] = True
+        return change
+
+    return {"attribute": attr, "old": old, "new": new}
+
+
+# compares a manifest with the old one entry by entry while it's being
+# written, so only the old one is kept in memory; the new manifest is added
+# in pieces of whole records
+class ManifestDiff():
+    def __init__(self, old_text: str):
+        self._old = parse_manifest(old_text)
+        self._seen = set()
+        self._changes = []
+
+    def add(self, new_text: str):
+        for path, record in parse_manifest(new_text).items():
+            self._seen.add(path)
+            old_record = self._old.get(path)
+            if old_record is None:
+                self._changes.append({"path": path, "status": "added"})
+                continue
+            if old_record == record:
+                continue
+
+            attrs = []
+            for attr, value in record.items():
+                if attr not in old_record:
+                    attrs.append(_diff_values(attr, None, value))
+                elif old_record[attr] != value:
+                    attrs.append(_diff_values(attr, old_record[attr], value))
+            for attr, value in old_record.items():
+                if attr not in record:
+                    attrs.append(_diff_values(attr, value, None))
+            self._changes.append({"path": path, "status": "changed", "attributes": attrs})
+
+    # the changed paths in the order of the new manifest followed by the
+    # removed ones
+    def changes(self):
+        return self._changes + [{"path": path, "status": "removed"}
+                                for path in self._old if path not in self._seen]
+
+
+def diff_manifests(old_text: str, new_text: str):
+    diff = ManifestDiff(old_text)
+    diff.add(new_text)
+    return diff.changes()
+
+
+def _format_value(v):
+    if v is None:
+        return "(none)"
+    elif isinstance(v, list):
+        return "[%s]" % ", ".join(v)
+    return v
+
+
+def format_diff(changes):
+    lines = []
+    for c in changes:
+        if c["status"] == "added":
+            lines.append("+ %s" % c["path"])
+        elif c["status"] == "removed":
+            lines.append("- %s" % c["path"])
+            continue
+
+        for a in c.get("attributes", []):
+            if "old" in a:
+                lines.append("%s: %s %s -> %s" % (
+                    c["path"], a["attribute"], _format_value(a["old"]), _format_value(a["new"])))
+            elif a.get("reordered"):
+                lines.append("%s: %s order changed" % (c["path"], a["attribute"]))
+            else:
+                lines.append("%s: %s %s" % (c["path"], a["attribute"], " ".join(
+                    ["+" + v for v in a["added"]] + ["-" + v for v in a["removed"]])))
+    return "\n".join(lines)
@@ -0,0 +1,74 @@
+import io
+import mmap
+import contextlib
+
+
+@contextlib.contextmanager
+def map_file(path: str):
+    # read-only memory map of a file, files that can't be mapped (empty or
+    # special files) are read instead; views of the map must be released
+    # before leaving the context
+    with open(path, "rb") as f:
+        try:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, OSError):
+            yield f.read()
+            return
+
+    with m:
+        yield m
+
+
+# file object over a buffer (a memory map or bytes) without copying it, only
+# what's read is copied; the view of the buffer is released when closed so
+# the map can be closed even if the reader is still referenced (e.g. by an
+# ELFFile)
+class BufferReader(io.RawIOBase):
+    def __init__(self, buf):
+        self._view = memoryview(buf)
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        if offset < 0:
+            raise ValueError("negative seek position %d" % offset)
+        self._pos = offset
+        return offset
+
+    # called for each field parsed by pyelftools, kept short; slices are
+    # clamped to the end of the view, and reading a released view raises
+    def read(self, size=-1):
+        pos = self._pos
+        if size is None or size < 0:
+            data = self._view[pos:].tobytes()
+        else:
+            data = self._view[pos:pos + size].tobytes()
+        self._pos = pos + len(data)
+        return data
+
+    def readall(self):
+        return self.read()
+
+    def readinto(self, b):
+        b = memoryview(b).cast("B")
+        n = max(0, min(len(b), len(self._view) - self._pos))
+        b[:n] = self._view[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._view.release()
+        super().close()
@@ -0,0 +1,166 @@
+import time
+import collections
+
+import profiling
+
+
+# a verb of an expectation, e.g. `.needed_libraries.contain("libc.so.6")`;
+# fn(value) returns (result, error template) like the comparisons of
+# ExpectChain; like ExpectChain._compare used to, a check stops at the first
+# file it fails on, and it's an error instead if any file doesn't have the
+# attribute at all
+class Check():
+    __slots__ = ("name", "attr", "fn", "reverse", "key", "ctx", "timing",
+                 "results", "failure", "missing", "stopped", "evaluated")
+
+    def __init__(self, name: str, attr: str, fn, reverse: bool, key, ctx: str):
+        self.name = name
+        self.attr = attr
+        self.fn = fn
+        self.reverse = reverse
+        self.key = key
+        # where the failure is reported from, see ExpectChain._print_fail
+        self.ctx = ctx
+        # [wall, cpu] of the rule, see Rule
+        self.timing = None
+        # truthy results of fn, or False once failed (see get_last_macthes)
+        self.results = []
+        self.failure = None
+        # first file without the attribute
+        self.missing = None
+        self.stopped = False
+        # checked ahead of the plan, see ExpectPlan.evaluate
+        self.evaluated = False
+
+    def compare(self, f, v):
+        if self.key and isinstance(v, dict):
+            # TODO: explicit flag to accept missing key
+            if self.key not in v:
+                self.stopped = True
+                self.results = True
+                return
+            v = v[self.key]
+        (r, err_template) = self.fn(v)
+        if r:
+            self.results.append(r)
+        if (not not r) == self.reverse:
+            self.failure = "file %s <%s>: %s" % (
+                f.relpath, self.attr, err_template.format(v, NOT="actually" if self.reverse else "not"))
+            self.results = False
+            self.stopped = True
+
+
+# `.exists()`, checked against the number of matched files; path_glob is
+# the one given to expect, for the failure message
+class ExistCheck():
+    __slots__ = ("path_glob", "reverse", "ctx")
+
+    def __init__(self, path_glob, reverse: bool, ctx: str):
+        self.path_glob = path_glob
+        self.reverse = reverse
+        self.ctx = ctx
+
+
+# an expectation as recorded by ExpectChain.expect: the globs of the files it
+# applies to and its steps in order, Check, ExistCheck or an error message
+class Rule():
+    def __init__(self, globs, title: str, skipped: bool = False):
+        self.globs = tuple(globs)
+        self.title = title
+        self.skipped = skipped
+        self.steps = []
+        self.files = []
+        self.matched = False
+        # time spent checking it, for the profile
+        self.timing = [0.0, 0.0]
+
+    def add(self, step):
+        if isinstance(step, Check):
+            step.timing = self.timing
+        self.steps.append(step)
+        return step
+
+
+# the expectations of a suite, recorded first and then checked in one pass
+# over the files: the rules are grouped by their globs so each group is
+# matched once, and each file is visited once with all the checks of the
+# rules it matches, its attributes being resolved once for all of them;
+# has_attr and value are those of ExpectChain, has_attr returns None for the
+# files an attribute doesn't apply to
+class ExpectPlan():
+    def __init__(self, infos, index, has_attr, value):
+        self._infos = infos
+        self._index = index
+        self._has_attr = has_attr
+        self._value = value
+        self.rules = []
+
+    def add(self, rule: Rule):
+        self.rules.append(rule)
+        return rule
+
+    def _visit(self, check: Check, f, has: dict, values: dict):
+        attr = check.attr
+        if attr in has:
+            h = has[attr]
+        else:
+            h = has[attr] = self._has_attr(f, attr)
+        if h is None:
+            return  # doesn't apply to the file
+        if not h:
+            check.missing = f
+        elif not check.stopped:
+            if attr in values:
+                v = values[attr]
+            else:
+                v = values[attr] = self._value(f, attr)
+            check.compare(f, v)
+
+    # checks a single rule right away, for the suites that need its results
+    # to record the next ones (see ExpectChain.get_last_macthes)
+    def evaluate(self, rule: Rule, check: Check, matcher):
+        if not rule.matched:
+            rule.files = [self._infos[i] for i in self._index.match(rule.globs, matcher)]
+            rule.matched = True
+        for f in rule.files:
+            if check.missing:
+                break
+            self._visit(check, f, {}, {})
+        check.evaluated = True
+
+    def execute(self, compile_globs):
+        groups = collections.OrderedDict()
+        for rule in self.rules:
+            if not rule.skipped:
+                groups.setdefault(rule.globs, []).append(rule)
+
+        # file position -> (rules, checks) of the groups matching it
+        visits = collections.defaultdict(list)
+        for globs, rules in groups.items():
+            group = ([r for r in rules if not r.matched],
+                     [s for r in rules for s in r.steps if isinstance(s, Check) and not s.evaluated])
+            for i in self._index.match(globs, compile_globs(globs)):
+                visits[i].append(group)
+
+        timed = profiling.profiler is not None
+        for i in sorted(visits):
+            f = self._infos[i]
+            has = {}
+            values = {}
+            for rules, checks in visits[i]:
+                for rule in rules:
+                    rule.files.append(f)
+                for check in checks:
+                    if check.missing:
+                        continue
+                    if not timed:
+                        self._visit(check, f, has, values)
+                        continue
+                    wall = time.perf_counter()
+                    cpu = time.thread_time()
+                    self._visit(check, f, has, values)
+                    check.timing[0] += time.perf_counter() - wall
+                    check.timing[1] += time.thread_time() - cpu
+
+        for rule in self.rules:
+            rule.matched = True
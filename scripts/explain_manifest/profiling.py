@@ -0,0 +1,147 @@
+import json
+import time
+import heapq
+import threading
+import contextlib
+import tracemalloc
+
+# profiler of the current run, see set_profiler; phases are not recorded when
+# it's not set
+profiler = None
+
+
+def set_profiler(p):
+    global profiler
+    profiler = p
+
+
+class Phase():
+    __slots__ = ("name", "wall", "cpu", "peak_memory")
+
+    def __init__(self, name):
+        self.name = name
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+        self.peak_memory = 0
+
+
+# records the wall and CPU time of the phases of a run (extraction, analysis,
+# expectations, etc) and their peak memory with tracemalloc; phases can be
+# nested and are aggregated by name, files analyzed by worker processes
+# (--jobs) are not traced by tracemalloc
+class Profiler():
+    def __init__(self, slowest_files=20, trace_memory=True):
+        self.slowest_files = slowest_files
+        self.trace_memory = trace_memory
+        # name -> {"count", "wall", "cpu", "peak_memory"}, in first seen order
+        self._phases = {}
+        self._files = []
+        self._lock = threading.Lock()
+        # the current phases of each thread
+        self._local = threading.local()
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        self._peak_memory = 0
+
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def start(self, name: str):
+        phase = Phase(name)
+        stack = self._stack()
+        if self.trace_memory:
+            # the peak is reset for each phase, the enclosing one keeps the
+            # peak reached so far
+            if stack:
+                stack[-1].peak_memory = max(stack[-1].peak_memory, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        stack.append(phase)
+        return phase
+
+    def stop(self, phase: Phase):
+        wall = time.perf_counter() - phase.wall
+        cpu = time.thread_time() - phase.cpu
+        stack = self._stack()
+        stack.remove(phase)
+        if self.trace_memory:
+            phase.peak_memory = max(phase.peak_memory, tracemalloc.get_traced_memory()[1])
+            if stack:
+                stack[-1].peak_memory = max(stack[-1].peak_memory, phase.peak_memory)
+
+        with self._lock:
+            p = self._phases.setdefault(phase.name, {
+                "count": 0, "wall": 0.0, "cpu": 0.0, "peak_memory": 0})
+            p["count"] += 1
+            p["wall"] += wall
+            p["cpu"] += cpu
+            p["peak_memory"] = max(p["peak_memory"], phase.peak_memory)
+            self._peak_memory = max(self._peak_memory, phase.peak_memory)
+
+    # a phase measured by the caller, e.g. when its work is interleaved with
+    # others (see plan.py); its memory is not traced
+    def add(self, name: str, wall: float, cpu: float):
+        with self._lock:
+            p = self._phases.setdefault(name, {
+                "count": 0, "wall": 0.0, "cpu": 0.0, "peak_memory": 0})
+            p["count"] += 1
+            p["wall"] += wall
+            p["cpu"] += cpu
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        p = self.start(name)
+        try:
+            yield
+        finally:
+            self.stop(p)
+
+    def record_files(self, infos):
+        # the analysis time is measured by main.explain_file, in the worker
+        # processes as well
+        with self._lock:
+            for f in infos:
+                t = getattr(f, "_analysis_time", None)
+                if t:
+                    self._files.append((t[0], t[1], f.relpath))
+            self._files = heapq.nlargest(self.slowest_files, self._files)
+
+    def result(self):
+        return {
+            "wall": time.perf_counter() - self._wall,
+            "cpu": time.process_time() - self._cpu,
+            "peak_memory": max(self._peak_memory, tracemalloc.get_traced_memory()[1])
+            if self.trace_memory else None,
+            "phases": [dict(name=name, **p) for name, p in self._phases.items()],
+            "slowest_files": [{"path": path, "wall": wall, "cpu": cpu}
+                              for wall, cpu, path in self._files],
+        }
+
+    def write(self, path: str):
+        with open(path, "w") as f:
+            json.dump(self.result(), f, indent=2)
+
+
+# shorthands recording into the current profiler, if any
+def start(name: str):
+    if profiler:
+        return profiler.start(name)
+    return None
+
+
+def stop(phase: Phase):
+    if profiler and phase:
+        profiler.stop(phase)
+
+
+@contextlib.contextmanager
+def phase(name: str):
+    if not profiler:
+        yield
+        return
+    with profiler.phase(name):
+        yield
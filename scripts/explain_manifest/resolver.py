@@ -0,0 +1,174 @@
+import os
+import collections
+
+# libraries the target system is expected to provide, needed libraries that
+# are not shipped are only accepted if they are listed here
+SYSTEM_LIBRARIES = (
+    "ld-linux-x86-64.so.2",
+    "ld-linux-aarch64.so.1",
+    "libc.so.6",
+    "libm.so.6",
+    "libdl.so.2",
+    "libpthread.so.0",
+    "librt.so.1",
+    "libgcc_s.so.1",
+    "libstdc++.so.6",
+    "libz.so.1",
+    "libcrypt.so.1",
+)
+
+# searched after RPATH/RUNPATH, like the ld.so defaults and the usual
+# multiarch directories of ld.so.cache
+DEFAULT_DIRS = (
+    "/lib64",
+    "/usr/lib64",
+    "/lib",
+    "/usr/lib",
+    "/lib/x86_64-linux-gnu",
+    "/usr/lib/x86_64-linux-gnu",
+    "/lib/aarch64-linux-gnu",
+    "/usr/lib/aarch64-linux-gnu",
+)
+
+MAX_SYMLINK_HOPS = 40
+
+
+class LoadClosure():
+    __slots__ = ("libraries", "unresolved", "depth")
+
+    def __init__(self):
+        # load order of (needed name, resolved path or None for system
+        # libraries, depth)
+        self.libraries = []
+        self.unresolved = []
+        self.depth = 0
+
+
+# resolves DT_NEEDED of the analyzed files inside the analyzed tree itself,
+# following the ld.so search order: DT_RPATH of the object and of its loaders
+# (only if the object has no DT_RUNPATH), DT_RUNPATH of the object, then the
+# default directories; $ORIGIN is expanded to the directory of the object
+class LibraryResolver():
+    def __init__(self, infos, symlinks=None, system_libraries=SYSTEM_LIBRARIES,
+                 default_dirs=DEFAULT_DIRS):
+        self.system_libraries = frozenset(system_libraries)
+        self._default_dirs = tuple(default_dirs)
+        self._files = {}
+        # symlinks to ELF files are not explained, they come separately
+        self._links = dict(symlinks or {})
+        for f in infos:
+            if hasattr(f, "link"):
+                self._links[f.relpath] = f.link
+            elif not hasattr(f, "directory"):
+                self._files[f.relpath] = f
+
+        # (search directories, needed name) -> (path, real path)
+        self._found = {}
+        # real path -> LoadClosure
+        self._closures = {}
+
+    def realpath(self, path: str):
+        # like os.path.realpath, inside the analyzed tree
+        parts = [p for p in path.split("/") if p and p != "."]
+        resolved = []
+        hops = 0
+        while parts:
+            part = parts.pop(0)
+            if part == "..":
+                if resolved:
+                    resolved.pop()
+                continue
+
+            link = self._links.get("/" + "/".join(resolved + [part]))
+            if link is None:
+                resolved.append(part)
+                continue
+
+            hops += 1
+            if hops > MAX_SYMLINK_HOPS:
+                return None
+            if link.startswith("/"):
+                resolved = []
+            parts = [p for p in link.split("/") if p and p != "."] + parts
+
+        return "/" + "/".join(resolved)
+
+    def _expand(self, search_path: str, origin: str):
+        dirs = []
+        for d in search_path.split(":"):
+            if not d:
+                continue
+            d = d.replace("${ORIGIN}", origin).replace("$ORIGIN", origin)
+            if "$" in d:
+                continue  # $LIB and $PLATFORM are not supported
+            dirs.append(d)
+        return dirs
+
+    def _search_dirs(self, obj, origin: str, loaders):
+        dirs = []
+        if obj.runpath:
+            dirs += self._expand(obj.runpath, origin)
+        else:
+            # DT_RPATH of the loaders is inherited, unless they have DT_RUNPATH
+            for o, o_origin in [(obj, origin)] + list(reversed(loaders)):
+                if o.rpath and not o.runpath:
+                    dirs += self._expand(o.rpath, o_origin)
+        return tuple(dirs) + self._default_dirs
+
+    def _find(self, dirs, name: str):
+        key = (dirs, name)
+        if key not in self._found:
+            found = (None, None)
+            candidates = [name] if "/" in name else [os.path.join(d, name) for d in dirs]
+            for path in candidates:
+                real = self.realpath(path)
+                if real in self._files:
+                    found = (os.path.normpath(path), real)
+                    break
+            self._found[key] = found
+        return self._found[key]
+
+    def closure(self, info):
+        real = self.realpath(info.relpath)
+        if real in self._closures:
+            return self._closures[real]
+
+        closure = LoadClosure()
+        # ld.so loads the dependencies breadth first, each of them once
+        loaded = set()
+        queue = collections.deque([(info, os.path.dirname(real), [], 0)])
+        while queue:
+            obj, origin, loaders, depth = queue.popleft()
+            dirs = None
+            for name in getattr(obj, "needed_libraries", None) or []:
+                if name in loaded:
+                    continue
+                loaded.add(name)
+
+                if dirs is None:
+                    dirs = self._search_dirs(obj, origin, loaders)
+                path, real_path = self._find(dirs, name)
+                if path:
+                    closure.libraries.append((name, path, depth + 1))
+                    queue.append((self._files[real_path], os.path.dirname(path),
+                                  loaders + [(obj, origin)], depth + 1))
+                elif name in self.system_libraries:
+                    closure.libraries.append((name, None, depth + 1))
+                else:
+                    closure.unresolved.append(name)
+                    continue
+                closure.depth = max(closure.depth, depth + 1)
+
+        self._closures[real] = closure
+        return closure
+
+    # values of the attributes exposed to the expectations, see expect.py
+    def attribute(self, info, attr: str):
+        closure = self.closure(info)
+        if attr == "unresolved_libraries":
+            return sorted(closure.unresolved)
+        elif attr == "library_closure":
+            return [path or "%s (system)" % name for name, path, _ in closure.libraries]
+        elif attr == "library_depth":
+            return closure.depth
+        raise AttributeError(attr)
@@ -41,6 +41,10 @@ def common_suites(expect, libxcrypt_no_obsolete_api: bool = False, skip_libsimdj
     expect("/usr/local/openresty/nginx/sbin/nginx", "nginx rpath should contain kong lib") \
         .rpath.equals("/usr/local/openresty/luajit/lib:/usr/local/kong/lib:/usr/local/openresty/lualib")
 
+    # the system libraries are those of the target, see ExpectSuite
+    expect("/usr/local/openresty/nginx/sbin/nginx", "nginx needed libraries resolve inside the package or the system") \
+        .unresolved_libraries.equals([])
+
     expect("/usr/local/openresty/nginx/sbin/nginx", "nginx binary should contain dwarf info for dynatrace") \
         .has_dwarf_info.equals(True) \
         .has_ngx_http_request_t_DW.equals(True)
@@ -57,27 +61,29 @@ def common_suites(expect, libxcrypt_no_obsolete_api: bool = False, skip_libsimdj
 
     expect("/usr/local/openresty/nginx/sbin/nginx", "nginx should include Kong's patches") \
         .functions \
-        .contain("ngx_http_lua_kong_ffi_set_grpc_authority") \
-        .contain("ngx_http_lua_ffi_balancer_enable_keepalive") \
-        .contain("ngx_http_lua_kong_ffi_set_dynamic_log_level") \
-        .contain("ngx_http_lua_kong_ffi_get_dynamic_log_level") \
-        .contain("ngx_http_lua_kong_ffi_get_static_tag") \
-        .contain("ngx_stream_lua_kong_ffi_get_static_tag") \
-        .contain("ngx_http_lua_kong_ffi_get_full_client_certificate_chain") \
-        .contain("ngx_http_lua_kong_ffi_disable_session_reuse") \
-        .contain("ngx_http_lua_kong_ffi_set_upstream_client_cert_and_key") \
-        .contain("ngx_http_lua_kong_ffi_set_upstream_ssl_trusted_store") \
-        .contain("ngx_http_lua_kong_ffi_set_upstream_ssl_verify") \
-        .contain("ngx_http_lua_kong_ffi_set_upstream_ssl_verify_depth") \
-        .contain("ngx_stream_lua_kong_ffi_get_full_client_certificate_chain") \
-        .contain("ngx_stream_lua_kong_ffi_disable_session_reuse") \
-        .contain("ngx_stream_lua_kong_ffi_set_upstream_client_cert_and_key") \
-        .contain("ngx_stream_lua_kong_ffi_set_upstream_ssl_trusted_store") \
-        .contain("ngx_stream_lua_kong_ffi_set_upstream_ssl_verify") \
-        .contain("ngx_stream_lua_kong_ffi_set_upstream_ssl_verify_depth") \
-        .contain("ngx_http_lua_kong_ffi_var_get_by_index") \
-        .contain("ngx_http_lua_kong_ffi_var_set_by_index") \
-        .contain("ngx_http_lua_kong_ffi_var_load_indexes")
+        .contain_all([
+            "ngx_http_lua_kong_ffi_set_grpc_authority",
+            "ngx_http_lua_ffi_balancer_enable_keepalive",
+            "ngx_http_lua_kong_ffi_set_dynamic_log_level",
+            "ngx_http_lua_kong_ffi_get_dynamic_log_level",
+            "ngx_http_lua_kong_ffi_get_static_tag",
+            "ngx_stream_lua_kong_ffi_get_static_tag",
+            "ngx_http_lua_kong_ffi_get_full_client_certificate_chain",
+            "ngx_http_lua_kong_ffi_disable_session_reuse",
+            "ngx_http_lua_kong_ffi_set_upstream_client_cert_and_key",
+            "ngx_http_lua_kong_ffi_set_upstream_ssl_trusted_store",
+            "ngx_http_lua_kong_ffi_set_upstream_ssl_verify",
+            "ngx_http_lua_kong_ffi_set_upstream_ssl_verify_depth",
+            "ngx_stream_lua_kong_ffi_get_full_client_certificate_chain",
+            "ngx_stream_lua_kong_ffi_disable_session_reuse",
+            "ngx_stream_lua_kong_ffi_set_upstream_client_cert_and_key",
+            "ngx_stream_lua_kong_ffi_set_upstream_ssl_trusted_store",
+            "ngx_stream_lua_kong_ffi_set_upstream_ssl_verify",
+            "ngx_stream_lua_kong_ffi_set_upstream_ssl_verify_depth",
+            "ngx_http_lua_kong_ffi_var_get_by_index",
+            "ngx_http_lua_kong_ffi_var_set_by_index",
+            "ngx_http_lua_kong_ffi_var_load_indexes",
+        ])
 
     expect("/usr/local/openresty/site/lualib/libatc_router.so", "ATC router so should have ffi module compiled") \
         .functions \
@@ -0,0 +1,60 @@
+import heapq
+import difflib
+import collections
+
+# number of candidates sharing the most trigrams with the word that are
+# compared with difflib when looking for close matches
+CLOSE_MATCH_CANDIDATES = 64
+# shorter words share too few trigrams with their close matches, they are
+# compared with every name
+CLOSE_MATCH_MIN_LENGTH = 8
+
+
+def _trigrams(s: str):
+    return {s[i:i+3] for i in range(len(s) - 2)}
+
+
+# sorted, immutable list of symbol names; membership checks go through a hash
+# set and "did you mean" suggestions through a trigram index instead of
+# scanning the whole list, both are built on first use
+class SymbolList(list):
+    def __init__(self, names=()):
+        super().__init__(sorted(names))
+        self._set = None
+        self._trigram_index = None
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("SymbolList is immutable")
+
+    append = extend = insert = remove = pop = clear = sort = reverse = _immutable
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _immutable
+
+    # the set and the index are not pickled (e.g. to the analysis cache)
+    def __reduce__(self):
+        return (SymbolList, (list(self),))
+
+    def __contains__(self, name):
+        if self._set is None:
+            self._set = frozenset(self)
+        return name in self._set
+
+    def _candidates(self, word: str):
+        if self._trigram_index is None:
+            index = collections.defaultdict(list)
+            for i, name in enumerate(self):
+                for g in _trigrams(name):
+                    index[g].append(i)
+            self._trigram_index = dict(index)
+
+        shared = collections.Counter()
+        for g in _trigrams(word):
+            shared.update(self._trigram_index.get(g, ()))
+        best = heapq.nlargest(CLOSE_MATCH_CANDIDATES, shared.items(), key=lambda x: x[1])
+        return [self[i] for i, _ in best]
+
+    # same as difflib.get_close_matches(word, self, n, cutoff), but only the
+    # names sharing the most trigrams with the word are compared
+    def close_matches(self, word: str, n: int = 3, cutoff: float = 0.6):
+        if len(word) < CLOSE_MATCH_MIN_LENGTH:
+            return difflib.get_close_matches(word, self, n, cutoff)
+        return difflib.get_close_matches(word, self._candidates(word), n, cutoff)
@@ -0,0 +1,109 @@
+import io
+import os
+import json
+import hashlib
+import tarfile
+import tempfile
+import unittest
+
+import config  # noqa: F401, imported before main
+import main
+from expect import ExpectChain, ExpectSuite
+
+KONG_CONF = b"prefix = /usr/local/kong/\nlog_level = notice\n"
+
+
+def _tar_gz(files):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w:gz") as tf:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            if data is None:
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+                tf.addfile(info)
+            else:
+                info.size = len(data)
+                info.mode = 0o644
+                tf.addfile(info, io.BytesIO(data))
+    return buf.getvalue()
+
+
+def _payload():
+    # a directory and a file that is not an ELF file, whose content is not
+    # read with the rest of the artifact
+    return {
+        "./etc/kong": None,
+        "./etc/kong/kong.conf.default": KONG_CONF,
+    }
+
+
+def write_deb(path):
+    members = [
+        ("debian-binary", b"2.0\n"),
+        ("control.tar.gz", _tar_gz({"./control": b"Package: kong\n"})),
+        ("data.tar.gz", _tar_gz(_payload())),
+    ]
+    with open(path, "wb") as f:
+        f.write(b"!<arch>\n")
+        for name, data in members:
+            f.write(("%-16s%-12d%-6d%-6d%-8s%-10d`\n" % (name, 0, 0, 0, "100644", len(data))).encode())
+            f.write(data)
+            if len(data) % 2:
+                f.write(b"\n")
+
+
+def write_oci(path):
+    def blob(data):
+        digest = "sha256:" + hashlib.sha256(data).hexdigest()
+        os.makedirs(os.path.join(path, "blobs", "sha256"), exist_ok=True)
+        with open(os.path.join(path, "blobs", "sha256", digest[7:]), "wb") as f:
+            f.write(data)
+        return digest
+
+    # the file is added by the upper layer
+    lower = blob(_tar_gz({"./etc/kong": None}))
+    upper = blob(_tar_gz(_payload()))
+    manifest = blob(json.dumps({"layers": [{"digest": lower}, {"digest": upper}]}).encode())
+    with open(os.path.join(path, "index.json"), "w") as f:
+        json.dump({"manifests": [{"digest": manifest}]}, f)
+
+
+def content_suite(expect, pattern):
+    expect("/etc/kong/**", "kong.conf.default sets the prefix") \
+        .text_content.matches(pattern)
+
+
+# the content expectations are checked on the files of packages and images
+# that are not materialized when the artifact is read
+class TestContentExpectations(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self._dir.cleanup)
+
+    def _failures(self, infos, pattern):
+        suite = ExpectSuite(name="content", manifest=None,
+                            tests={content_suite: {"pattern": pattern}})
+        E = ExpectChain(infos, exit_on_failure=False)
+        E.run(suite)
+        return E.failures()
+
+    def _check(self, infos):
+        self.assertEqual(self._failures(infos, r"prefix = /usr/local/kong/\n"), [])
+        failures = self._failures(infos, r"prefix = /opt/kong/\n")
+        self.assertEqual(len(failures), 1)
+        self.assertIn("/etc/kong/kong.conf.default <text_content>", failures[0])
+
+    def test_deb(self):
+        path = os.path.join(self._dir.name, "kong.deb")
+        write_deb(path)
+        self._check(main.walk_artifact(path, False, None))
+
+    def test_oci_image(self):
+        path = os.path.join(self._dir.name, "oci")
+        write_oci(path)
+        self._check(main.walk_artifact(path, True, None))
+
+
+if __name__ == "__main__":
+    unittest.main()
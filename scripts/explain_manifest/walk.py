@@ -0,0 +1,53 @@
+import os
+import stat
+
+
+class FileEntry():
+    __slots__ = ("name", "mode", "uid", "gid", "size", "mtime", "ino", "link")
+
+    # the content is read from the disk when needed
+    content = None
+    source = None
+    on_disk = True
+
+    def __init__(self, name, st, link=None):
+        self.name = name
+        self.mode = st.st_mode
+        self.uid = st.st_uid
+        self.gid = st.st_gid
+        self.size = st.st_size
+        # to tell modified files apart, see watch.py
+        self.mtime = st.st_mtime_ns
+        self.ino = st.st_ino
+        self.link = link
+
+    def is_dir(self):
+        return stat.S_ISDIR(self.mode)
+
+    def is_symlink(self):
+        return stat.S_ISLNK(self.mode)
+
+    def is_file(self):
+        return stat.S_ISREG(self.mode)
+
+
+def scan_tree(path: str, prefix: str = ""):
+    # yields FileEntry of everything under path in the same order as
+    # sorted(pathlib.Path(path).rglob("*")), each entry is lstat-ed once and
+    # symlinks to directories are not followed
+    try:
+        with os.scandir(os.path.join(path, prefix)) as it:
+            children = sorted(it, key=lambda e: e.name)
+    except (PermissionError, FileNotFoundError):
+        return
+
+    for e in children:
+        name = prefix + e.name
+        try:
+            st = e.stat(follow_symlinks=False)
+            link = os.readlink(e.path) if stat.S_ISLNK(st.st_mode) else None
+        except FileNotFoundError:
+            continue  # removed since listed, e.g. by a build still running
+        yield FileEntry(name, st, link)
+        if stat.S_ISDIR(st.st_mode):
+            yield from scan_tree(path, name + "/")
@@ -0,0 +1,155 @@
+import os
+import time
+
+from walk import scan_tree
+from manifest import diff_manifests, format_diff, format_manifest
+from explain import ExplainResults
+from expect import ExpectChain, compile_globs
+
+
+def _signature(entry):
+    return (entry.mode, entry.uid, entry.gid, entry.size, entry.mtime, entry.ino, entry.link)
+
+
+# keeps the explained files of a directory (e.g. the output of a build) in
+# memory and explains again only the files added, removed or modified since
+# the last poll; modified files are told apart by their lstat, so a file
+# rewritten in place within the mtime granularity with the same size is missed
+class Watcher():
+    def __init__(self, path: str, globs, opts, explain_files, jobs: int = 1, executor=None):
+        self.path = path
+        self._matcher = compile_globs(globs) if globs else None
+        self._opts = opts
+        # main.explain_files, passed in as main imports this module
+        self._explain_files = explain_files
+        self._jobs = jobs
+        self._executor = executor
+
+        # relpath -> FileEntry, in the order of the manifest
+        self._entries = {}
+        self._signatures = {}
+        self._infos = {}
+        self._records = {}
+        self._symlinks = {}
+        # last scan that differs from the state, processed once the tree
+        # stops changing (e.g. when the build is done writing)
+        self._pending = None
+        # manifest changes of the files explained by the last poll
+        self.delta = []
+
+    def _scan(self):
+        entries = {}
+        for entry in scan_tree(self.path):
+            if self._matcher and not self._matcher(entry.name):
+                continue
+            entries["/" + entry.name] = entry
+        return entries
+
+    def _explain(self, relpaths):
+        entries = [self._entries[p] for p in relpaths]
+        results = self._explain_files(
+            [os.path.join(self.path, p[1:]) for p in relpaths], relpaths, entries,
+            self._jobs, self._executor)
+        infos = {f.relpath: f for f in results}
+        for p in relpaths:
+            self._symlinks.pop(p, None)
+            f = infos.get(p)
+            self._infos[p] = f
+            self._records[p] = dict(f.explain(self._opts)) if f else None
+        self._symlinks.update(results.symlinks)
+
+    def start(self):
+        self._entries = self._scan()
+        self._signatures = {p: _signature(e) for p, e in self._entries.items()}
+        self._infos = {}
+        self._records = {}
+        self._symlinks = {}
+        self._explain(list(self._entries))
+
+    # returns (changed, removed) relpaths once the tree has changed and
+    # stopped changing since the previous poll, None otherwise
+    def poll(self):
+        entries = self._scan()
+        signatures = {p: _signature(e) for p, e in entries.items()}
+        if signatures == self._signatures:
+            self._pending = None
+            return None
+        if signatures != self._pending:
+            self._pending = signatures
+            return None
+        self._pending = None
+
+        changed = [p for p, s in signatures.items() if self._signatures.get(p) != s]
+        removed = [p for p in self._signatures if p not in signatures]
+        old_records = [self._records[p] for p in changed + removed if self._records.get(p)]
+
+        for p in removed:
+            del self._infos[p]
+            del self._records[p]
+            self._symlinks.pop(p, None)
+        self._entries = entries
+        self._signatures = signatures
+        self._explain(changed)
+
+        new_records = [self._records[p] for p in changed if self._records[p]]
+        # only the changed files are compared, the rest of the manifest is the same
+        self.delta = diff_manifests(format_manifest(old_records).decode("utf-8"),
+                                    format_manifest(new_records).decode("utf-8"))
+        return changed, removed
+
+    def infos(self):
+        return ExplainResults([self._infos[p] for p in self._entries if self._infos[p] is not None],
+                              dict(self._symlinks))
+
+    def manifest(self):
+        return format_manifest([self._records[p] for p in self._entries if self._records[p]])
+
+
+def _write_manifest(watcher: Watcher, output: str):
+    if output:
+        with open(output, "wb") as f:
+            f.write(watcher.manifest())
+
+
+def watch(watcher: Watcher, suite=None, output: str = None, interval: float = 0.25):
+    start = time.time()
+    watcher.start()
+    _write_manifest(watcher, output)
+    ExpectChain._log("[INFO] explained %d file(s) of %s in %.2fms" % (
+        len(watcher._entries), watcher.path, (time.time() - start) * 1000))
+
+    # failures of each expectation as of its last run
+    failures = {}
+    if suite:
+        E = ExpectChain(watcher.infos(), exit_on_failure=False)
+        E.compare_manifest(suite, watcher.manifest())
+        E.run(suite)
+        failures.update(E.results())
+
+    try:
+        while True:
+            time.sleep(interval)
+            start = time.time()
+            r = watcher.poll()
+            if not r:
+                continue
+
+            changed, removed = r
+            _write_manifest(watcher, output)
+            ExpectChain._log("[INFO] %d file(s) changed, %d removed, explained in %.2fms" % (
+                len(changed), len(removed), (time.time() - start) * 1000))
+            if watcher.delta:
+                print(format_diff(watcher.delta))
+
+            if suite:
+                E = ExpectChain(watcher.infos(), exit_on_failure=False,
+                                changed_paths=changed + removed)
+                E.run(suite)
+                failures.update(E.results())
+                failed = [f for v in failures.values() for f in v]
+                ExpectChain._log("[INFO] %d expectation(s) run again, %d failure(s) in total" % (
+                    len(E.results()), len(failed)))
+    except KeyboardInterrupt:
+        pass
+
+    return failures